@@ -0,0 +1,91 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class ExactIndex(object):
+    """
+    Exhaustive cosine search.
+    search(query, history) returns, for every (L2-normalized) query row, the most similar sample
+    whose index is not in the same row of history (b x h).
+    """
+    def __init__(self, data):
+        self.data = F.normalize(data.detach().float(), dim=1)
+
+    def search(self, query, history):
+        sim = torch.mm(query, self.data.t())
+        sim.scatter_(1, history, float('-inf'))
+        return sim.argmax(dim=1)
+
+
+class IVFIndex(object):
+    """
+    Inverted-file cosine search: samples are grouped into nlist spherical k-means cells and a query
+    only scans the members of its nprobe most similar cells. nprobe trades recall for speed
+    (nprobe = nlist is exact). Rows whose probed cells hold no admissible sample fall back to an
+    exhaustive search.
+    """
+    def __init__(self, data, nlist, nprobe, niter=10, seed=0):
+        data = F.normalize(data.detach().float(), dim=1)
+        num_sam = data.size(0)
+        nlist = max(1, min(nlist, num_sam))
+        self.nprobe = max(1, min(nprobe, nlist))
+
+        generator = torch.Generator().manual_seed(seed)
+        centroids = data[torch.randperm(num_sam, generator=generator)[:nlist].to(data.device)]
+        for _ in range(niter):
+            assign = self._assign(data, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, data)
+            counts = torch.bincount(assign, minlength=nlist)
+            centroids = torch.where(counts[:, None] > 0, F.normalize(sums, dim=1), centroids)
+        self.centroids = centroids
+        self.assign = self._assign(data, centroids)
+
+        # members of a cell are contiguous in sorted_data, order maps sorted positions back to samples
+        self.order = torch.argsort(self.assign)
+        self.pos = torch.empty_like(self.order).scatter_(0, self.order, torch.arange(num_sam, device=data.device))
+        self.sorted_data = data[self.order]
+        counts = torch.bincount(self.assign, minlength=nlist)
+        self.counts = counts.tolist()
+        self.starts = (torch.cumsum(counts, dim=0) - counts).tolist()
+
+    @staticmethod
+    def _assign(data, centroids, block_size=8192):
+        return torch.cat([torch.mm(data[i:i + block_size], centroids.t()).argmax(dim=1)
+                          for i in range(0, data.size(0), block_size)])
+
+    def search(self, query, history):
+        best = torch.full((query.size(0),), float('-inf'), device=query.device)
+        best_idx = torch.full((query.size(0),), -1, dtype=torch.long, device=query.device)
+        probes = torch.mm(query, self.centroids.t()).topk(self.nprobe, dim=1)[1]
+        history_cell = self.assign[history]
+        history_col = self.pos[history]
+
+        for c in torch.unique(probes).tolist():
+            start, count = self.starts[c], self.counts[c]
+            if count == 0:
+                continue
+            rows = (probes == c).any(dim=1).nonzero().squeeze(1)
+            sim = torch.mm(query[rows], self.sorted_data[start:start + count].t())
+            r, h = (history_cell[rows] == c).nonzero(as_tuple=True)
+            sim[r, history_col[rows][r, h] - start] = float('-inf')
+            val, arg = sim.max(dim=1)
+            better = val > best[rows]
+            best[rows[better]] = val[better]
+            best_idx[rows[better]] = self.order[start + arg[better]]
+
+        missing = (best_idx < 0).nonzero().squeeze(1)
+        if len(missing) > 0:
+            sim = torch.mm(query[missing], self.sorted_data.t())
+            sim.scatter_(1, self.pos[history[missing]], float('-inf'))
+            best_idx[missing] = self.order[sim.argmax(dim=1)]
+        return best_idx
+
+
+def build_index(data, kind='exact', nlist=0, nprobe=8):
+    # nlist = 0 picks sqrt(num_sample) cells
+    if kind == 'exact':
+        return ExactIndex(data)
+    if kind == 'ivf':
+        return IVFIndex(data, nlist or int(math.sqrt(data.size(0))), nprobe)
+    raise ValueError('Unknown anchor index: ' + kind)
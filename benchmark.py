@@ -0,0 +1,538 @@
+import argparse
+import math
+import os
+import os.path as osp
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, TensorDataset
+import network, loss, anchor_index, runtime, checkpoint
+from runtime import timeit
+
+
+def check_close(name, new, ref, args):
+    # Fails the benchmark when new drifts from its reference by more than --atol + --rtol * |ref|
+    new, ref = torch.as_tensor(new, dtype=torch.float64), torch.as_tensor(ref, dtype=torch.float64)
+    diff = torch.max(torch.abs(new - ref)).item()
+    if not torch.allclose(new, ref, rtol=args.rtol, atol=args.atol):
+        raise AssertionError('{}: max |diff| {:.2e} exceeds --atol {} / --rtol {}'.format(name, diff, args.atol, args.rtol))
+    return diff
+
+
+def build_sources(num_src, args, device, net=None):
+    net = net or args.net
+    if net[0:3] == 'vgg':
+        netF_list = [network.VGGBase(vgg_name=net, pretrained=False).to(device) for _ in range(num_src)]
+    else:
+        netF_list = [network.ResBase(res_name=net, pretrained=False).to(device) for _ in range(num_src)]
+    netB_list = [network.feat_bottleneck(type='bn', feature_dim=netF_list[0].in_features,
+                                         bottleneck_dim=256).to(device) for _ in range(num_src)]
+    netC_list = [network.feat_classifier(type='wn', class_num=args.class_num, bottleneck_dim=256).to(device)
+                 for _ in range(num_src)]
+    return netF_list, netB_list, netC_list
+
+
+def bench_ensemble(args, device):
+    # One training iteration (forward + backward) of all source models, looped vs. vmapped
+    x = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    # VGGBase has dropout in its classifier, which the batched path must run in train mode too
+    ensemble = network.MultiSourceNet(*build_sources(2, args, device, 'vgg11'), batched=True).train()
+    _, _, outputs = ensemble(x[:2])
+    outputs.sum().backward()
+    print('vgg11 batched train step: ok')
+    del ensemble, outputs
+    for num_src in args.sources:
+        nets = build_sources(num_src, args, device)
+        times = []
+        modes = [dict(batched=False), dict(batched=True)]
+        if args.placement:
+            modes.append(dict(devices=(args.placement * num_src)[:num_src]))
+        for mode in modes:
+            ensemble = network.MultiSourceNet(*nets, **mode).train()
+
+            def step():
+                _, _, outputs = ensemble(x)
+                outputs.sum().backward()
+
+            times.append(timeit(step, device, args.repeat))
+        log_str = 'sources: {}, loop: {:.1f} ms/iter, batched: {:.1f} ms/iter, speedup: {:.2f}x'.format(
+            num_src, times[0] * 1000, times[1] * 1000, times[0] / times[1])
+        if args.placement:
+            log_str += ', placed: {:.1f} ms/iter, speedup: {:.2f}x'.format(times[2] * 1000, times[0] / times[2])
+        print(log_str)
+
+
+def kl_consistency_reference(output, pred_label, args):
+    # The original per-class / per-source-pair loop of loss.KLConsistencyLoss
+    eps = 1e-16
+    KL_loss = 0
+    label_id = np.unique(pred_label.cpu().numpy())
+    for cls in range(args.class_num):
+        if cls in label_id:
+            prob_cls_all = torch.ones(len(args.src), args.class_num, device=output.device)
+            for i in range(len(args.src)):
+                mask_cls = pred_label == cls
+                mask_cls_ex = torch.repeat_interleave(mask_cls.unsqueeze(1), args.class_num, dim=1)
+                logits_cls = torch.sum(output[i] * mask_cls_ex.float(), dim=0)
+                cls_num = torch.sum(mask_cls)
+                prob_cls = torch.softmax(logits_cls * 1.0 / (cls_num + eps), dim=0)
+                prob_cls_all[i] = torch.clamp(prob_cls, 1e-8, 1.0)
+            for m in range(len(args.src)):
+                for n in range(len(args.src)):
+                    KL_div = torch.sum(prob_cls_all[m] * torch.log(prob_cls_all[m] / prob_cls_all[n])) + \
+                             torch.sum(prob_cls_all[n] * torch.log(prob_cls_all[n] / prob_cls_all[m]))
+                    KL_loss += KL_div / 2
+    return KL_loss / (args.class_num * len(args.src))
+
+
+def bench_kl(args, device):
+    for class_num in args.classes:
+        for num_src in args.sources:
+            kl_args = SimpleNamespace(class_num=class_num, src=list(range(num_src)))
+            output = torch.randn(num_src, args.batch_size, class_num, device=device)
+            pred = torch.randint(0, class_num, (args.batch_size,), device=device)
+            ref = kl_consistency_reference(output, pred, kl_args)
+            new = loss.KLConsistencyLoss(output, pred, kl_args)
+            diff = check_close('KLConsistencyLoss, {} classes, {} sources'.format(class_num, num_src), new, ref, args)
+            t_ref = timeit(lambda: kl_consistency_reference(output, pred, kl_args), device, args.repeat)
+            t_new = timeit(lambda: loss.KLConsistencyLoss(output, pred, kl_args), device, args.repeat)
+            print('classes: {}, sources: {}, |diff|: {:.2e}, loop: {:.2f} ms, vectorized: {:.3f} ms, speedup: {:.1f}x'.format(
+                class_num, num_src, diff, t_ref * 1000, t_new * 1000, t_ref / t_new))
+
+
+def check_equal(name, new, ref):
+    # Fails the benchmark when two integer results (anchors, labels) differ anywhere
+    new, ref = np.asarray(new), np.asarray(ref)
+    mismatch = int(np.sum(new != ref))
+    if mismatch > 0:
+        raise AssertionError('{}: {} of {} entries differ from the reference'.format(name, mismatch, ref.size))
+
+
+def nearest_id_search_reference(Q, X, is_mem_f, step_num, mtx_ignore, nearest_idx_last_f):
+    # The original dense float64 search of nearest_confi_anchor, num_sample x num_sample per call
+    Xt = np.transpose(X)
+    Simo = np.dot(Q, Xt)
+    nq = np.expand_dims(np.linalg.norm(Q, axis=1), axis=1)
+    nx = np.expand_dims(np.linalg.norm(X, axis=1), axis=0)
+    Nor = np.dot(nq, nx)
+    Sim = 1 - (Simo / Nor)
+
+    indices_min = np.argmin(Sim, axis=1)
+    indices_row = np.arange(0, Q.shape[0], 1)
+
+    idx_change = np.where((indices_min - nearest_idx_last_f) != 0)[0]
+    if is_mem_f == 1:
+        if idx_change.shape[0] != 0:
+            indices_min[idx_change] = nearest_idx_last_f[idx_change]
+    Sim[indices_row, indices_min] = 1000
+
+    # Ignore the history search records.
+    if is_mem_f == 1:
+        for k in range(step_num):
+            indices_ingore = mtx_ignore[:, k]
+            Sim[indices_row, indices_ingore] = 1000
+
+    indices_min_cur = np.argmin(Sim, axis=1)
+    indices_self = indices_min
+    return indices_min_cur, indices_self
+
+
+def nearest_confi_anchor_reference(data_q, data_all, lab_confi):
+    # The original confident-anchor walk, one dense search over all samples per hop
+    data_q_ = data_q.detach().cpu().numpy()
+    data_all_ = data_all.detach().cpu().numpy()
+    num_sam = data_q.shape[0]
+    LN_MEM = 70
+
+    flag_is_done = 0
+    ctr_oper = 0
+    idx_left = np.arange(0, num_sam, 1)
+    mtx_mem_rlt = -3 * np.ones((num_sam, LN_MEM), dtype='int64')
+    mtx_mem_ignore = np.zeros((num_sam, LN_MEM), dtype='int64')
+    is_mem = 0
+    mtx_log = np.zeros((num_sam, LN_MEM), dtype='int64')
+    indices_row = np.arange(0, num_sam, 1)
+    nearest_idx_last = np.array([-7])
+
+    while flag_is_done == 0:
+        nearest_idx_tmp, idx_last_tmp = nearest_id_search_reference(data_q_, data_all_, is_mem, ctr_oper,
+                                                                    mtx_mem_ignore, nearest_idx_last)
+        is_mem = 1
+        nearest_idx_last = nearest_idx_tmp
+        flag_sw_bad = 1 if ctr_oper == (LN_MEM - 1) else 0
+
+        mtx_mem_rlt[:, ctr_oper] = nearest_idx_tmp
+        mtx_mem_ignore[:, ctr_oper] = idx_last_tmp
+
+        lab_confi_tmp = lab_confi[nearest_idx_tmp]
+        idx_done_tmp = np.where(lab_confi_tmp == 1)[0]
+        idx_left[idx_done_tmp] = -1
+
+        if flag_sw_bad == 1:
+            idx_bad = np.where(idx_left >= 0)[0]
+            mtx_log[idx_bad, 0] = 1
+        else:
+            mtx_log[:, ctr_oper] = lab_confi_tmp
+
+        flag_len = len(np.where(idx_left >= 0)[0])
+        if flag_len == 0 or flag_sw_bad == 1:
+            idx_nn_step = []
+            for k in range(num_sam):
+                row = list(mtx_log[k, :])
+                idx_nn_step.append(row.index(1) if 1 in row else 0)
+            idx_nn_re = mtx_mem_rlt[indices_row, idx_nn_step]
+            data_re = data_all[idx_nn_re, :]
+            flag_is_done = 1
+        else:
+            data_q_ = data_all_[nearest_idx_tmp, :]
+        ctr_oper += 1
+
+    return data_re, idx_nn_re, idx_nn_step
+
+
+def bench_anchor(args, device):
+    # How often the IVF anchor walk picks a different anchor than the exact one, on clustered features
+    from train_target_CAiDA import nearest_confi_anchor
+    torch.manual_seed(0)
+    centers = F.normalize(torch.randn(args.class_num, args.dim), dim=1)
+    labels = torch.randint(0, args.class_num, (args.samples,))
+    feats = (centers[labels] + 0.8 * torch.randn(args.samples, args.dim) / math.sqrt(args.dim)).to(device)
+    label_confi = (torch.rand(args.samples) < 0.5).long().to(device)
+
+    # the blockwise walk and a full-probe ivf index against the original walk, on the first --ref_samples
+    # samples (the reference holds num_sample x num_sample float64 matrices)
+    n = min(args.samples, args.ref_samples)
+    _, ref, ref_step = nearest_confi_anchor_reference(feats[:n], feats[:n], label_confi[:n].cpu().numpy())
+    _, new, new_step = nearest_confi_anchor(feats[:n], feats[:n], label_confi[:n])
+    check_equal('blockwise anchors', new.cpu(), ref)
+    check_equal('blockwise anchor hops', new_step.cpu(), ref_step)
+    nlist = args.nlist or int(math.sqrt(n))
+    full = anchor_index.IVFIndex(feats[:n], nlist, nlist)
+    check_equal('ivf anchors at nprobe = nlist', nearest_confi_anchor(feats[:n], feats[:n], label_confi[:n], index=full)[1].cpu(), ref)
+    print('{} samples: blockwise and ivf (nprobe = nlist = {}) anchors identical to the original walk'.format(n, nlist))
+
+    start = time.perf_counter()
+    exact = nearest_confi_anchor(feats, feats, label_confi)[1]
+    t_exact = time.perf_counter() - start
+    print('exact: {:.2f} s'.format(t_exact))
+    nlist = args.nlist or int(math.sqrt(args.samples))
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        index = anchor_index.IVFIndex(feats, nlist, nprobe)
+        t_build = time.perf_counter() - start
+        idx = nearest_confi_anchor(feats, feats, label_confi, index=index)[1]
+        t_search = time.perf_counter() - start - t_build
+        diff = torch.mean((idx != exact).float()).item()
+        print('ivf nlist: {}, nprobe: {}, build: {:.2f} s, walk: {:.2f} s, speedup: {:.1f}x, anchors differing: {:.2f}%'.format(
+            nlist, nprobe, t_build, t_search, t_exact / (t_build + t_search), diff * 100))
+
+
+def cluster_pseudo_label_reference(all_output, all_feature, all_feature_F, all_label, args):
+    # The original float64 numpy post-processing of obtain_pseudo_label (argsort top-2, cdist, one-hot centroids)
+    from scipy.spatial.distance import cdist
+    all_output = torch.softmax(all_output, dim=1)
+    all_prob = all_output.float().cpu().numpy()
+    prob_max_id = all_prob.argsort(axis=1)[:, -1]
+    prob_max2_id = all_prob.argsort(axis=1)[:, -2]
+    prob_max = np.zeros(all_prob.shape[0])
+    prob_max2 = np.zeros(all_prob.shape[0])
+    for i in range(all_prob.shape[0]):
+        prob_max[i] = all_prob[i, prob_max_id[i]]
+        prob_max2[i] = all_prob[i, prob_max2_id[i]]
+    prob_diff_tsr = torch.from_numpy(prob_max - prob_max2)
+    idx_unconfi_list_prob = prob_diff_tsr.topk(int((all_prob.shape[0] * 0.5)), largest=False)[-1].numpy().tolist()
+
+    all_fea = torch.cat((all_feature, torch.ones(all_feature.size(0), 1)), 1)
+    all_fea = (all_fea.t() / torch.norm(all_fea, p=2, dim=1)).t()
+    all_fea = all_fea.float().cpu().numpy()
+    K = all_output.size(1)
+    aff = all_output.float().cpu().numpy()
+    initc = aff.transpose().dot(all_fea)
+    initc = initc / (1e-8 + aff.sum(axis=0)[:, None])
+    dd = cdist(all_fea, initc, 'cosine')
+    pred_label = dd.argmin(axis=1)
+
+    dd_min_id = dd.argsort(axis=1)[:, 0]
+    dd_min2_id = dd.argsort(axis=1)[:, 1]
+    dd_min = np.zeros(dd.shape[0])
+    dd_min2 = np.zeros(dd.shape[0])
+    for i in range(dd.shape[0]):
+        dd_min[i] = dd[i, dd_min_id[i]]
+        dd_min2[i] = dd[i, dd_min2_id[i]]
+    dd_diff_tsr = torch.from_numpy(dd_min2 - dd_min)
+    idx_confi = dd_diff_tsr.topk(int((dd.shape[0] * 0.5)), largest=True)[-1].numpy().tolist()
+    idx_all_arr = np.zeros(shape=dd.shape[0], dtype=np.int64)
+    idx_all_arr[idx_confi] = 1
+    idx_unconfi_list_dd = list(np.where(idx_all_arr == 0)[0])
+    idx_unconfi_list = list(set(idx_unconfi_list_dd).intersection(set(idx_unconfi_list_prob)))
+    label_confi = np.ones(all_prob.shape[0], dtype="int64")
+    label_confi[idx_unconfi_list] = 0
+    _, all_idx_nn, _ = nearest_confi_anchor_reference(all_feature_F, all_feature_F, label_confi)
+
+    gamma = 0.15 * np.random.randn(label_confi.shape[0], 1) + 0.85
+    all_fea_fuse = gamma * all_fea + (1 - gamma) * all_fea[all_idx_nn]
+    aff = np.eye(K)[pred_label]
+    initc = aff.transpose().dot(all_fea_fuse)
+    initc = initc / (1e-8 + aff.sum(axis=0)[:, None])
+    pred_label = cdist(all_fea_fuse, initc, args.distance).argmin(axis=1)
+    return pred_label.astype('int'), label_confi
+
+
+def bench_pseudo_label(args, device):
+    # The torch pseudo-label engine against the original numpy one, same seeded inputs and gamma draws
+    from train_target_CAiDA import cluster_pseudo_label
+    torch.manual_seed(0)
+    n = args.ref_samples
+    centers = F.normalize(torch.randn(args.class_num, args.dim), dim=1)
+    labels = torch.randint(0, args.class_num, (n,))
+    feats_F = centers[labels] + 0.8 * torch.randn(n, args.dim) / math.sqrt(args.dim)
+    feats = feats_F[:, :256] + 0.1 * torch.randn(n, 256)
+    outputs = 10 * torch.mm(feats_F, centers.t()) + torch.randn(n, args.class_num)
+    for distance in ['cosine', 'euclidean']:
+        pl_args = SimpleNamespace(distance=distance, pl_chunk=max(1, n // 3), anchor_index='exact', ivf_nlist=0,
+                                  ivf_nprobe=8, rank=0)
+        np.random.seed(args.seed)
+        start = time.perf_counter()
+        ref_label, ref_confi = cluster_pseudo_label_reference(outputs, feats, feats_F, labels.float(), pl_args)
+        t_ref = time.perf_counter() - start
+        np.random.seed(args.seed)
+        start = time.perf_counter()
+        new_label, _, new_confi, _ = cluster_pseudo_label(outputs.to(device), feats.to(device), feats_F.to(device),
+                                                          labels.float().to(device), pl_args)
+        t_new = time.perf_counter() - start
+        check_equal('label_confi ({})'.format(distance), new_confi.cpu(), ref_confi)
+        check_equal('pseudo-labels ({})'.format(distance), new_label.cpu(), ref_label)
+        print('{} samples, {}: identical pseudo-labels and label_confi, numpy {:.2f} s, torch {:.2f} s, speedup {:.1f}x'.format(
+            n, distance, t_ref, t_new, t_ref / t_new))
+
+
+def bench_amp(args, device):
+    # One source-model training step per precision mode, and how far its eval logits drift from fp32
+    torch.manual_seed(0)
+    x = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    netF, netB, netC = [net[0] for net in build_sources(1, args, device)]
+    with torch.no_grad():
+        ref = netC(netB(netF.eval()(x))).float()
+    for amp in args.amp:
+        for channels_last in [False, True]:
+            if amp == 'fp16' and device.type == 'cpu':
+                continue
+            layout = torch.channels_last if channels_last else torch.contiguous_format
+            netF = netF.to(memory_format=layout)
+            xs = runtime.channels_last(x, channels_last)
+            with torch.no_grad(), runtime.autocast(device.type, amp):
+                out = netC(netB(netF.eval()(xs))).float()
+            agree = torch.mean((out.argmax(1) == ref.argmax(1)).float()).item()
+            diff = torch.max(torch.abs(out - ref)).item()
+
+            netF.train()
+            scaler = runtime.grad_scaler(device.type, amp)
+
+            def step():
+                with runtime.autocast(device.type, amp):
+                    outputs = netC(netB(netF(xs)))
+                netF.zero_grad()
+                scaler.scale(outputs.float().logsumexp(1).mean()).backward()
+
+            t = timeit(step, device, args.repeat)
+            print('amp: {}, channels_last: {}, {:.1f} ms/iter, {:.1f} img/s, top-1 agreement with fp32: {:.2f}%, '
+                  'max |logit diff|: {:.2e}'.format(amp, channels_last, t * 1000, args.batch_size / t, agree * 100, diff))
+
+
+def bench_loader(args, device):
+    # Time to the first batch of every epoch, with workers respawned per epoch vs. persistent workers
+    dset = TensorDataset(torch.randint(0, 256, (args.batch_size * 8, 3, 256, 256), dtype=torch.uint8))
+    for persistent in [False, True]:
+        loader = DataLoader(dset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers,
+                            persistent_workers=persistent, prefetch_factor=4 if persistent else 2,
+                            pin_memory=device.type == 'cuda')
+        stalls = []
+        for epoch in range(3):
+            start = time.perf_counter()
+            for i, (x,) in enumerate(loader):
+                if i == 0:
+                    stalls.append(time.perf_counter() - start)
+                x.to(device, non_blocking=True)
+        print('persistent workers: {}, first batch of epoch 1: {:.0f} ms, of later epochs: {:.0f} ms'.format(
+            persistent, stalls[0] * 1000, np.mean(stalls[1:]) * 1000))
+
+
+def bench_transforms(args, device):
+    # Parity of the uint8 path (ToUint8Array + BatchCrop + normalize_batch) with image_test / image_train,
+    # and the time of both for one batch
+    from PIL import Image
+    from torchvision.transforms import functional as TF
+    from train_source import image_train, image_test
+    from data_list import ToUint8Array, BatchCrop, normalize_batch
+    rng = np.random.RandomState(0)
+    imgs = [Image.fromarray(rng.randint(0, 256, (rng.randint(200, 500), rng.randint(200, 500), 3), dtype=np.uint8))
+            for _ in range(args.batch_size)]
+    to_uint8 = ToUint8Array()
+
+    ref = torch.stack([image_test()(img) for img in imgs])
+    new = normalize_batch(BatchCrop(train=False)([(to_uint8(img), 0) for img in imgs])[0])
+    print('center crop vs. image_test: max |diff| {:.2e}'.format(check_close('center crop', new, ref, args)))
+
+    # BatchCrop draws all tops, then all lefts, then all flips; the reference crops and flips every
+    # image on its own with the same draws (the offsets and flip probability of RandomCrop/RandomHorizontalFlip)
+    n, size = len(imgs), 224
+    torch.manual_seed(args.seed)
+    new = normalize_batch(BatchCrop(train=True)([(to_uint8(img), 0) for img in imgs])[0])
+    torch.manual_seed(args.seed)
+    top, left = torch.randint(0, 256 - size + 1, (n,)), torch.randint(0, 256 - size + 1, (n,))
+    flip = torch.rand(n) < 0.5
+    ref = []
+    for img, t, l, f in zip(imgs, top.tolist(), left.tolist(), flip.tolist()):
+        img = TF.crop(img.resize((256, 256), Image.BILINEAR), t, l, size, size)
+        img = TF.hflip(img) if f else img
+        ref.append(TF.normalize(TF.to_tensor(img), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]))
+    ref = torch.stack(ref)
+    print('random crop + flip vs. per-image crop/hflip (seed {}): max |diff| {:.2e}, offsets {}..{}, flipped {}/{}'.format(
+        args.seed, check_close('random crop + flip', new, ref, args), min(top.min(), left.min()).item(),
+        max(top.max(), left.max()).item(), flip.sum().item(), n))
+
+    train = image_train()
+    t_ref = timeit(lambda: torch.stack([train(img) for img in imgs]), torch.device('cpu'), args.repeat)
+    t_new = timeit(lambda: normalize_batch(BatchCrop(train=True)([(to_uint8(img), 0) for img in imgs])[0].to(device)),
+                   device, args.repeat)
+    print('batch of {}: image_train {:.1f} ms, uint8 + BatchCrop {:.1f} ms, speedup {:.2f}x'.format(
+        n, t_ref * 1000, t_new * 1000, t_ref / t_new))
+
+
+def make_dataset_reference(image_list):
+    # The original list of (path, label) tuples built by data_list.make_dataset
+    return [(val.split()[0], int(val.split()[1])) for val in image_list]
+
+
+def private_memory():
+    # Private (copied-on-write or newly allocated) resident memory of this process in bytes, linux only
+    with open('/proc/self/smaps_rollup') as f:
+        return sum(int(line.split()[1]) for line in f if line.startswith(('Private_Clean', 'Private_Dirty'))) * 1024
+
+
+class TableScan(torch.utils.data.Dataset):
+    # Item k of a forked worker reads every entry of the table, as the worker would over an epoch,
+    # and returns how much of the inherited memory it had to copy doing so
+    def __init__(self, table, workers):
+        self.table = table
+        self.workers = workers
+
+    def __len__(self):
+        return self.workers
+
+    def __getitem__(self, k):
+        before = private_memory()
+        for i in range(len(self.table)):
+            path, label = self.table[i]
+        return private_memory() - before
+
+
+def bench_index(args, device):
+    # Dataset construction time and per-worker memory growth after fork, list of tuples vs. ImageIndex
+    import gc
+    from data_list import make_dataset
+    lines = ['data/office-home/Real_World/class_{0:03d}/image_{1:07d}.jpg {0}\n'.format(i % 345, i)
+             for i in range(args.samples)]
+    for name, build in [('list of tuples', make_dataset_reference), ('ImageIndex', lambda l: make_dataset(l, None))]:
+        start = time.perf_counter()
+        table = build(lines)
+        t_build = time.perf_counter() - start
+        gc.collect()
+        loader = DataLoader(TableScan(table, args.workers), batch_size=None, num_workers=args.workers,
+                            multiprocessing_context='fork')
+        growth = [x for x in loader]
+        print('{}: {} entries built in {:.2f} s, private memory per forked worker +{:.1f} MB'.format(
+            name, len(table), t_build, np.mean(growth) / 2 ** 20))
+        del table, loader
+
+
+def bench_startup(args, device):
+    # Model construction + checkpoint loading of train_target, the old path (initialize, then torch.load
+    # every file) vs. the new one (no initialization, memory-mapped sources.pt), and the script's import time
+    num_src = max(args.sources)
+    with tempfile.TemporaryDirectory() as dset_dir:
+        for i, (netF, netB, netC) in enumerate(zip(*build_sources(num_src, args, torch.device('cpu')))):
+            os.makedirs(osp.join(dset_dir, str(i)))
+            for part, net in zip(checkpoint.SOURCE_PARTS, [netF, netB, netC]):
+                torch.save(net.state_dict(), osp.join(dset_dir, str(i), 'source_' + part + '.pt'))
+        checkpoint.consolidate_sources(dset_dir)
+
+        def build(uninitialized):
+            nets = []
+            sources = checkpoint.SourceCheckpoints(dset_dir)
+            for i in range(num_src):
+                fns = [lambda: network.ResBase(res_name=args.net, pretrained=False),
+                       lambda: network.feat_bottleneck(type='bn', feature_dim=nets[-1].in_features, bottleneck_dim=256),
+                       lambda: network.feat_classifier(type='wn', class_num=args.class_num, bottleneck_dim=256)]
+                for part, fn in zip(checkpoint.SOURCE_PARTS, fns):
+                    if uninitialized:
+                        nets.append(network.uninitialized(fn, device))
+                        nets[-1].load_state_dict(sources.load(str(i), part))
+                    else:
+                        nets.append(fn().to(device))
+                        path = osp.join(dset_dir, str(i), 'source_' + part + '.pt')
+                        nets[-1].load_state_dict(torch.load(path, map_location=device))
+            return nets
+
+        t_old = timeit(lambda: build(False), device, repeat=3, warmup=1)
+        t_new = timeit(lambda: build(True), device, repeat=3, warmup=1)
+    print('{} sources: initialize + load {:.2f} s, uninitialized + mmap {:.2f} s, speedup {:.1f}x'.format(
+        num_src, t_old, t_new, t_old / t_new))
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import train_target_CAiDA'], check=True,
+                   cwd=osp.dirname(osp.abspath(__file__)))
+    print('import train_target_CAiDA: {:.2f} s'.format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CAiDA benchmarks')
+    parser.add_argument('bench', type=str, choices=['ensemble', 'kl', 'anchor', 'amp', 'loader', 'startup', 'transforms', 'index', 'pseudo_label'])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--net', type=str, default='resnet50')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--class_num', type=int, default=65)
+    parser.add_argument('--sources', type=int, nargs='+', default=[2, 3, 5])
+    parser.add_argument('--classes', type=int, nargs='+', default=[31, 65, 345])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=2048)
+    parser.add_argument('--nlist', type=int, default=0)
+    parser.add_argument('--ref_samples', type=int, default=2000, help="samples of the checks against the original numpy code")
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--amp', type=str, nargs='+', default=['off', 'bf16', 'fp16'])
+    parser.add_argument('--placement', type=str, nargs='+', default=None,
+                        help="devices the sources are spread over (round robin) for a placed ensemble run")
+    parser.add_argument('--workers', type=int, default=4, help="DataLoader workers of the loader benchmark")
+    parser.add_argument('--threads', type=int, default=0, help="intra-op threads, 0 for the torch default")
+    parser.add_argument('--seed', type=int, default=2022)
+    parser.add_argument('--atol', type=float, default=1e-5, help="absolute tolerance of the parity checks")
+    parser.add_argument('--rtol', type=float, default=1e-4, help="relative tolerance of the parity checks")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    if args.bench == 'ensemble':
+        bench_ensemble(args, device)
+    elif args.bench == 'kl':
+        bench_kl(args, device)
+    elif args.bench == 'anchor':
+        bench_anchor(args, device)
+    elif args.bench == 'amp':
+        bench_amp(args, device)
+    elif args.bench == 'loader':
+        bench_loader(args, device)
+    elif args.bench == 'startup':
+        bench_startup(args, device)
+    elif args.bench == 'transforms':
+        bench_transforms(args, device)
+    elif args.bench == 'index':
+        bench_index(args, device)
+    elif args.bench == 'pseudo_label':
+        bench_pseudo_label(args, device)
@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import os
+import os.path as osp
+import threading
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes state dicts from a background thread so the training loop does not wait for the disk.
+    save({path: module or state dict}) snapshots the tensors into CPU buffers (asynchronous copies
+    from the gpu) and returns; the thread writes every file to path.tmp and renames it over path.
+    Checkpoints that have not changed since the last write to the same path are skipped: without
+    any copy when no tensor was modified in place since the last snapshot (e.g. frozen modules),
+    otherwise by a hash of their content. Saves that arrive while the thread is busy replace
+    pending ones for the same paths, so a burst of new bests is written once, with the latest weights.
+    """
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.versions = {}
+        self.hashes = {}
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, checkpoints):
+        self._check()
+        for path, state in checkpoints.items():
+            if isinstance(state, nn.Module):
+                state = state.state_dict()
+            versions = [(k, v.data_ptr(), v._version) for k, v in state.items()]
+            if self.versions.get(path) == versions:
+                continue
+            self.versions[path] = versions
+            snapshot, events = self._snapshot(state)
+            with self.cond:
+                self.pending[path] = (snapshot, events)
+                self.cond.notify()
+
+    def close(self):
+        # Waits for the pending writes
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _snapshot(state):
+        snapshot = OrderedDict()
+        snapshot._metadata = getattr(state, '_metadata', None)
+        devices = set()
+        for k, v in state.items():
+            v = v.detach()
+            snapshot[k] = torch.empty(v.shape, dtype=v.dtype, pin_memory=v.is_cuda).copy_(v, non_blocking=True)
+            if v.is_cuda:
+                devices.add(v.device)
+        events = []
+        for device in devices:
+            with torch.cuda.device(device):
+                events.append(torch.cuda.Event())
+                events[-1].record()
+        return snapshot, events
+
+    @staticmethod
+    def _digest(snapshot):
+        h = hashlib.sha1()
+        for k, v in snapshot.items():
+            h.update(k.encode())
+            h.update(str((v.dtype, tuple(v.shape))).encode())
+            h.update(v.contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+        return h.digest()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                path, (snapshot, events) = self.pending.popitem(last=False)
+            try:
+                for event in events:
+                    event.synchronize()
+                digest = self._digest(snapshot)
+                if self.hashes.get(path) == digest:
+                    continue
+                torch.save(snapshot, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self.hashes[path] = digest
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+SOURCE_PARTS = ['F', 'B', 'C']
+
+
+def load_mmap(path):
+    # tensors stay on disk (in the page cache) until they are read, e.g. by load_state_dict
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except TypeError: # torch < 2.1
+        return torch.load(path, map_location='cpu')
+
+
+def consolidate_sources(dset_dir, domains=None):
+    """
+    Packs the source_{F,B,C}.pt checkpoints of every domain folder of dset_dir (ckps/source/<dset>)
+    into one dset_dir/sources.pt, {domain: {part: state dict}}.
+    """
+    if domains is None:
+        domains = sorted(d for d in os.listdir(dset_dir) if osp.exists(osp.join(dset_dir, d, 'source_F.pt')))
+    sources = {d: {part: torch.load(osp.join(dset_dir, d, 'source_' + part + '.pt'), map_location='cpu')
+                   for part in SOURCE_PARTS} for d in domains}
+    path = osp.join(dset_dir, 'sources.pt')
+    torch.save(sources, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+class SourceCheckpoints(object):
+    """
+    Source checkpoints of one dataset folder (ckps/source/<dset>). load(domain, part) reads from the
+    memory-mapped consolidated sources.pt when it is newer than the per-domain files, so a source's
+    tensors are only read when its state dicts are loaded into a model, and from the memory-mapped
+    <domain>/source_<part>.pt otherwise.
+    """
+    def __init__(self, dset_dir):
+        self.dset_dir = dset_dir
+        self.sources = None
+        path = osp.join(dset_dir, 'sources.pt')
+        if osp.exists(path):
+            newest = max([osp.getmtime(osp.join(dset_dir, d, f)) for d in os.listdir(dset_dir)
+                          if osp.isdir(osp.join(dset_dir, d)) for f in os.listdir(osp.join(dset_dir, d))
+                          if f.startswith('source_')] or [0])
+            if osp.getmtime(path) >= newest:
+                self.sources = load_mmap(path)
+
+    def path(self, domain, part):
+        # the file load(domain, part) reads
+        if self.sources is not None and domain in self.sources:
+            return osp.join(self.dset_dir, 'sources.pt')
+        return osp.join(self.dset_dir, domain, 'source_' + part + '.pt')
+
+    def load(self, domain, part):
+        if self.sources is not None and domain in self.sources:
+            return self.sources[domain][part]
+        return load_mmap(self.path(domain, part))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Consolidate the source checkpoints of a dataset')
+    parser.add_argument('dset_dir', type=str, help="e.g. ckps/source/office-31")
+    parser.add_argument('--domains', type=str, nargs='+', default=None, help="domain folders (default: all)")
+    args = parser.parse_args()
+    print(consolidate_sources(args.dset_dir, args.domains))
@@ -3,22 +3,65 @@ import numpy as np
 import random
 from PIL import Image
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 import os
 import os.path
-import cv2
+import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
 import torchvision
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+
+
+class ImageIndex(object):
+    # Compact (path, label) table: all paths live in one uint8 buffer addressed by an
+    # int64 offsets array, labels in one int64 array (n, or n x m for multi-label lists).
+    # A handful of numpy arrays pickle into DataLoader workers in one piece and are never
+    # touched by refcounting, so forked workers keep sharing their pages.
+    def __init__(self, paths, labels):
+        self.offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, paths), dtype=np.int64, count=len(paths)), out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        self.labels = labels
+
+    def path(self, index):
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].tobytes().decode()
+
+    def paths(self):
+        return [self.path(i) for i in range(len(self))]
+
+    def __getitem__(self, index):
+        if self.labels.ndim == 1:
+            return self.path(index), int(self.labels[index])
+        return self.path(index), self.labels[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.offsets) - 1
 
 
 def make_dataset(image_list, labels):
-    if labels:
-        len_ = len(image_list)
-        images = [(image_list[i].strip(), labels[i, :]) for i in range(len_)]
-    else:
-        if len(image_list[0].split()) > 2:
-            images = [(val.split()[0], np.array([int(la) for la in val.split()[1:]])) for val in image_list]
-        else:
-            images = [(val.split()[0], int(val.split()[1])) for val in image_list]
-    return images
+    if labels is not None:
+        paths = [line.strip().encode() for line in image_list]
+        return ImageIndex(paths, np.asarray(labels))
+    if len(image_list) == 0:
+        return ImageIndex([], np.zeros(0, dtype=np.int64))
+
+    # Every line is "path label [label ...]", so one split over the joined list gives a
+    # flat token stream with a fixed stride.
+    width = len(image_list[0].split())
+    tokens = '\n'.join(image_list).encode().split()
+    if len(tokens) % width != 0:
+        raise RuntimeError('Malformed image list, expected {} fields per line'.format(width))
+    labels = np.array([tokens[i::width] for i in range(1, width)]).astype(np.int64).T
+    if width == 2:
+        labels = np.ascontiguousarray(labels[:, 0])
+    return ImageIndex(tokens[0::width], labels)
 
 
 def rgb_loader(path):
@@ -33,8 +76,151 @@ def l_loader(path):
             return img.convert('L')
 
 
+def build_image_cache(list_path, prefix, resize_size=256, num_threads=None):
+    # Decode every entry of list_path once into <prefix>.img.npy (n x size x size x 3 uint8),
+    # <prefix>.lbl.npy and <prefix>.idx.txt. The index file is renamed into place last, so
+    # its presence marks a complete cache. Temporary files are per process.
+    with open(list_path) as f:
+        imgs = make_dataset(f.readlines(), None)
+    tmp = '{}.tmp{}'.format(prefix, os.getpid())
+    images = np.lib.format.open_memmap(tmp + '.img.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(imgs), resize_size, resize_size, 3))
+
+    def decode(i):
+        img = rgb_loader(imgs.path(i))
+        images[i] = np.asarray(img.resize((resize_size, resize_size), Image.BILINEAR))
+
+    with ThreadPoolExecutor(num_threads or os.cpu_count()) as pool:
+        list(pool.map(decode, range(len(imgs))))
+    images.flush()
+    del images
+
+    np.save(tmp + '.lbl.npy', imgs.labels)
+    with open(tmp + '.idx.txt', 'w') as f:
+        for path in imgs.paths():
+            f.write(path + '\n')
+    for suffix in ['.img.npy', '.lbl.npy', '.idx.txt']:
+        os.replace(tmp + suffix, prefix + suffix)
+    return prefix
+
+
+def ensure_image_cache(list_path, cache_dir=None, resize_size=256, num_threads=None):
+    root = osp.splitext(list_path)[0]
+    if cache_dir is not None:
+        root = osp.join(cache_dir, osp.basename(osp.dirname(osp.abspath(list_path))), osp.basename(root))
+    prefix = '{}.cache{}'.format(root, resize_size)
+    index = prefix + '.idx.txt'
+
+    def ready():
+        return osp.exists(index) and osp.getmtime(index) >= osp.getmtime(list_path)
+
+    if not ready():
+        os.makedirs(osp.dirname(prefix) or '.', exist_ok=True)
+        # Processes sharing the cache (torchrun ranks, train_source_all.py jobs) take an exclusive
+        # lock: the first one builds it, the others wait and find it complete on the re-check.
+        with open(prefix + '.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not ready():
+                    print('Building image cache {} from {}'.format(prefix, list_path))
+                    build_image_cache(list_path, prefix, resize_size, num_threads)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+    return prefix
+
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class ToUint8Array(object):
+    # Per-sample half of the uint8 path: resize only and keep HWC uint8, cache rows
+    # are already resized and pass through untouched.
+    def __init__(self, resize_size=256):
+        self.resize_size = resize_size
+
+    def __call__(self, img):
+        if isinstance(img, np.ndarray):
+            return img
+        return np.asarray(img.resize((self.resize_size, self.resize_size), Image.BILINEAR))
+
+
+class BatchCrop(object):
+    # collate_fn for ToUint8Array datasets: RandomCrop + RandomHorizontalFlip (train) or
+    # CenterCrop (test) for the whole batch with one gather, still in uint8.
+    # Normalization is left to normalize_batch on the training device.
+    def __init__(self, crop_size=224, train=True):
+        self.crop_size = crop_size
+        self.train = train
+
+    def __call__(self, batch):
+        imgs = torch.from_numpy(np.stack([item[0] for item in batch])).permute(0, 3, 1, 2)
+        n, _, h, w = imgs.shape
+        size = self.crop_size
+        if self.train:
+            top = torch.randint(0, h - size + 1, (n,))
+            left = torch.randint(0, w - size + 1, (n,))
+        else:
+            top = torch.full((n,), int(round((h - size) / 2.0)), dtype=torch.long)
+            left = torch.full((n,), int(round((w - size) / 2.0)), dtype=torch.long)
+        offsets = torch.arange(size)
+        rows = top[:, None] + offsets
+        cols = left[:, None] + offsets
+        if self.train:
+            flip = torch.rand(n) < 0.5
+            cols = torch.where(flip[:, None], cols.flip(1), cols)
+        imgs = imgs[torch.arange(n)[:, None, None, None], torch.arange(3)[None, :, None, None],
+                    rows[:, None, :, None], cols[:, None, None, :]]
+        return [imgs] + list(default_collate([item[1:] for item in batch]))
+
+
+def normalize_batch(inputs):
+    # ToTensor + Normalize for uint8 batches from BatchCrop, float batches pass through.
+    if inputs.dtype != torch.uint8:
+        return inputs
+    mean = torch.tensor(IMAGENET_MEAN, device=inputs.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=inputs.device).view(1, 3, 1, 1)
+    return (inputs.float().div_(255) - mean) / std
+
+
+class ImageCache(object):
+    # Read-only view of a shard written by build_image_cache. The memmap is opened lazily
+    # in each process and never pickled, so DataLoader workers share the same page-cache
+    # pages instead of receiving a copy of the images.
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.prefix + '.img.npy', mmap_mode='r')
+        return self._images
+
+    def index(self, paths):
+        with open(self.prefix + '.idx.txt') as f:
+            rows = {line.rstrip('\n'): i for i, line in enumerate(f)}
+        missing = [path for path in paths if path not in rows]
+        if len(missing) > 0:
+            raise RuntimeError('{} images (e.g. {}) are missing from cache {}, rebuild it'.format(
+                len(missing), missing[0], self.prefix))
+        return np.array([rows[path] for path in paths], dtype=np.int64)
+
+    def __getitem__(self, row):
+        return self.images[row]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+
 class ImageList(Dataset):
-    def __init__(self, image_list, labels=None, transform=None, target_transform=None, mode='RGB'):
+    return_index = False
+
+    def __init__(self, image_list, labels=None, transform=None, target_transform=None, mode='RGB', cache=None):
         imgs = make_dataset(image_list, labels)
         if len(imgs) == 0:
             raise (RuntimeError("Found 0 images in subfolders"))
@@ -47,43 +233,50 @@ class ImageList(Dataset):
         elif mode == 'L':
             self.loader = l_loader
 
+        self.cache = None
+        if cache is not None:
+            if mode != 'RGB':
+                raise ValueError('Image cache only stores RGB images')
+            self.cache = ImageCache(cache)
+            self.cache_rows = self.cache.index(imgs.paths())
+
     def __getitem__(self, index):
         path, target = self.imgs[index]
-        img = self.loader(path)
+        if self.cache is not None:
+            img = self.cache[self.cache_rows[index]]
+            if not isinstance(self.transform, ToUint8Array):
+                img = Image.fromarray(img)
+        else:
+            img = self.loader(path)
         if self.transform is not None:
             img = self.transform(img)
         if self.target_transform is not None:
             target = self.target_transform(target)
 
+        if self.return_index:
+            return img, target, index
         return img, target
 
     def __len__(self):
         return len(self.imgs)
 
 
-class ImageList_idx(Dataset):
-    def __init__(self, image_list, labels=None, transform=None, target_transform=None, mode='RGB'):
-        imgs = make_dataset(image_list, labels)
-        if len(imgs) == 0:
-            raise (RuntimeError("Found 0 images in subfolders"))
+class ImageList_idx(ImageList):
+    return_index = True
 
-        self.imgs = imgs
-        self.transform = transform
-        self.target_transform = target_transform
-        if mode == 'RGB':
-            self.loader = rgb_loader
-        elif mode == 'L':
-            self.loader = l_loader
 
-    def __getitem__(self, index):
-        path, target = self.imgs[index]
-        img = self.loader(path)
-        if self.transform is not None:
-            img = self.transform(img)
-        if self.target_transform is not None:
-            target = self.target_transform(target)
+class LazyLoaders(dict):
+    """
+    dict of DataLoaders that are only built when they are first looked up, from the
+    factories given to register(name, factory). Assigning a loader directly replaces its factory.
+    """
+    def __init__(self):
+        super(LazyLoaders, self).__init__()
+        self.factories = {}
 
-        return img, target, index
+    def register(self, name, factory):
+        self.factories[name] = factory
 
-    def __len__(self):
-        return len(self.imgs)
+    def __missing__(self, name):
+        self[name] = self.factories[name]()
+        return self[name]
@@ -0,0 +1,164 @@
+import argparse
+import os
+import os.path as osp
+import random
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+import network, loss, runtime
+from runtime import timeit
+from checkpoint import AsyncCheckpointWriter
+from data_list import ImageList, ImageList_idx, ToUint8Array, BatchCrop, normalize_batch
+from predict import Predictor
+from train_source import op_copy, lr_scheduler, cal_acc
+
+
+def teacher_logits(predictor, list_path, args):
+    """
+    netQ-weighted logits of the adapted ensemble on the center crops of list_path, computed once and
+    cached in args.output/teacher_<savename>.pt (rebuilt when the list is newer than the cache, or when the
+    target checkpoints of the ensemble changed).
+    Returns:
+        logits: num_sample x K teacher logits, on the cpu
+        accuracy: teacher accuracy on the labels of the list
+    """
+    cache = osp.join(args.output, 'teacher_' + args.savename + '.pt')
+    ckpts = [(osp.abspath(path), osp.getmtime(path), osp.getsize(path)) for path in predictor.paths]
+    if osp.exists(cache) and osp.getmtime(cache) >= osp.getmtime(list_path):
+        state = torch.load(cache, map_location='cpu')
+        if state['list'] == osp.abspath(list_path) and state.get('ckpts') == ckpts:
+            print('Teacher logits: ' + cache)
+            return state['logits'], state['accuracy']
+
+    dset = ImageList_idx(open(list_path).readlines(), transform=ToUint8Array())
+    loader = DataLoader(dset, batch_size=args.batch_size * 2, shuffle=False, collate_fn=BatchCrop(train=False),
+                        **runtime.loader_options(args))
+    logits = torch.empty(len(dset), predictor.class_num)
+    labels = torch.empty(len(dset), dtype=torch.long)
+    start = time.perf_counter()
+    for inputs, batch_labels, idx in loader:
+        logits[idx] = predictor(inputs)[0].cpu()
+        labels[idx] = batch_labels
+    accuracy = (logits.argmax(dim=1) == labels).float().mean().item() * 100
+    print('Teacher logits of {} images in {:.1f} s'.format(len(dset), time.perf_counter() - start))
+    torch.save({'list': osp.abspath(list_path), 'ckpts': ckpts, 'logits': logits, 'accuracy': accuracy}, cache)
+    return logits, accuracy
+
+
+def distill(args):
+    predictor = Predictor(args.ckpt_dir, args.savename, args.net, args.classifier, args.layer, args.device,
+                          args.amp, args.channels_last)
+    teacher, teacher_acc = teacher_logits(predictor, args.list, args)
+    targets = torch.softmax(teacher / args.temperature, dim=1)
+
+    lines = open(args.list).readlines()
+    train_loader = DataLoader(ImageList_idx(lines, transform=ToUint8Array()), batch_size=args.batch_size,
+                              shuffle=True, drop_last=True, collate_fn=BatchCrop(train=True),
+                              **runtime.loader_options(args))
+    test_loader = DataLoader(ImageList(lines, transform=ToUint8Array()), batch_size=args.batch_size * 2,
+                             shuffle=False, collate_fn=BatchCrop(train=False), **runtime.loader_options(args))
+
+    netF = network.ResBase(res_name=args.student).to(args.device)
+    netB = network.feat_bottleneck(type=args.classifier, feature_dim=netF.in_features,
+                                   bottleneck_dim=args.bottleneck).to(args.device)
+    netC = network.feat_classifier(type=args.layer, class_num=predictor.class_num,
+                                   bottleneck_dim=args.bottleneck).to(args.device)
+    if args.channels_last:
+        netF = netF.to(memory_format=torch.channels_last)
+    model = nn.Sequential(netF, netB, netC)
+
+    param_group = []
+    for k, v in netF.named_parameters():
+        param_group += [{'params': v, 'lr': args.lr * 0.1}]
+    for k, v in list(netB.named_parameters()) + list(netC.named_parameters()):
+        param_group += [{'params': v, 'lr': args.lr}]
+    optimizer = op_copy(optim.SGD(param_group))
+    scaler = runtime.grad_scaler(torch.device(args.device).type, args.amp)
+    criterion = loss.softCrossEntropy()
+
+    max_iter = args.max_epoch * len(train_loader)
+    iter_num = 0
+    best_acc = 0
+    writer = AsyncCheckpointWriter()
+    for epoch in range(args.max_epoch):
+        model.train()
+        num_img, tick = 0, time.perf_counter()
+        for inputs, _, idx in train_loader:
+            lr_scheduler(optimizer, iter_num=iter_num, max_iter=max_iter)
+            iter_num += 1
+            inputs = runtime.channels_last(normalize_batch(inputs.to(args.device, non_blocking=True)), args.channels_last)
+            soft = targets[idx].to(args.device, non_blocking=True)
+            with runtime.autocast(inputs.device.type, args.amp):
+                outputs = model(inputs)
+            # T^2 keeps the gradient scale of the soft targets independent of the temperature
+            distill_loss = criterion(outputs.float() / args.temperature, soft) * args.temperature ** 2
+
+            optimizer.zero_grad()
+            scaler.scale(distill_loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            num_img += inputs.size(0)
+        throughput = num_img / (time.perf_counter() - tick)
+
+        if (epoch + 1) % args.interval == 0 or epoch + 1 == args.max_epoch:
+            model.eval()
+            acc, _ = cal_acc(test_loader, netF, netB, netC, args, False)
+            print('Epoch:{}/{}; Loss = {:.4f}; Student accuracy = {:.2f}%, teacher {:.2f}%; Throughput = {:.1f} img/s'.format(
+                epoch + 1, args.max_epoch, distill_loss.item(), acc, teacher_acc, throughput))
+            if acc >= best_acc:
+                best_acc = acc
+                writer.save({osp.join(args.output, 'student_' + part + '_' + args.savename + '.pt'): net
+                             for part, net in zip(['F', 'B', 'C'], [netF, netB, netC])})
+    writer.close()
+
+    # inference cost of one batch: n backbones + heads against one
+    model.eval()
+    x = torch.randn(args.batch_size, 3, 224, 224, device=args.device)
+    x = runtime.channels_last(x, args.channels_last)
+    device = torch.device(args.device)
+    with torch.no_grad(), runtime.autocast(device.type, args.amp):
+        teacher_time = timeit(lambda: predictor.ensemble(x), device)
+        student_time = timeit(lambda: model(x), device)
+    print('Student ({}) accuracy {:.2f}%, ensemble of {} ({}) {:.2f}%; {:.1f} ms vs. {:.1f} ms per batch of {}, '
+          'speedup {:.2f}x'.format(args.student, best_acc, len(predictor.ensemble.netF_list), args.net, teacher_acc,
+                                   student_time * 1000, teacher_time * 1000, args.batch_size, teacher_time / student_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Distill an adapted CAiDA ensemble into a single student network')
+    parser.add_argument('--ckpt_dir', type=str, required=True, help="train_target_CAiDA.py output folder, e.g. ckps/MSFDA/office-31/D")
+    parser.add_argument('--savename', type=str, default='par_0.7_0.01', help="checkpoint suffix, par_<cls_par>_<crc_par>")
+    parser.add_argument('--list', type=str, required=True, help="target image list, e.g. data/office-31/dslr_list.txt")
+    parser.add_argument('--output', type=str, default=None, help="folder of the student checkpoints (default: --ckpt_dir)")
+    parser.add_argument('--net', type=str, default='resnet50', help="backbone of the ensemble, vgg16, resnet50, resnet101")
+    parser.add_argument('--student', type=str, default='resnet18', choices=list(network.res_dict.keys()))
+    parser.add_argument('--layer', type=str, default="wn", choices=["linear", "wn"])
+    parser.add_argument('--classifier', type=str, default="bn", choices=["ori", "bn"])
+    parser.add_argument('--bottleneck', type=int, default=256)
+    parser.add_argument('--temperature', type=float, default=1.0, help="softmax temperature of the soft targets")
+    parser.add_argument('--max_epoch', type=int, default=10)
+    parser.add_argument('--interval', type=int, default=1, help="epochs between evaluations")
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--worker', type=int, default=4, help="number of workers")
+    parser.add_argument('--lr', type=float, default=1e-2, help="learning rate")
+    parser.add_argument('--seed', type=int, default=2022, help="random seed")
+    parser.add_argument('--gpu_id', type=str, nargs='?', default='0', help="device id to run")
+    parser.add_argument('--device', type=str, default=None, help="cuda, cuda:<n> or cpu (default: cuda when available)")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads of the main process, 0 for the cores left over by the workers")
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--channels_last', action='store_true')
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    runtime.setup_device(args)
+    args.output = args.output or args.ckpt_dir
+    os.makedirs(args.output, exist_ok=True)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+
+    distill(args)
@@ -0,0 +1,149 @@
+import argparse
+import os
+import os.path as osp
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+import runtime
+from runtime import timeit
+from data_list import ImageList, ToUint8Array, BatchCrop, normalize_batch
+from predict import Predictor
+
+
+def fuse_heads(ensemble, weights):
+    """
+    One Linear over the concatenated backbone features of the n sources that equals the
+    weights-weighted sum of their bottleneck (+ BatchNorm in eval mode) and weight-normed classifier
+    heads: sum_i w_i (C_i (B_i f_i + b_i) + c_i) = [w_1 C_1 B_1, ..., w_n C_n B_n] [f_1; ...; f_n] + sum_i w_i (C_i b_i + c_i).
+    The folding is done in float64.
+    """
+    with torch.no_grad():
+        cls_weight, cls_bias = [x.double() for x in ensemble.classifier_weights()]
+        blocks, bias = [], 0
+        for netB, C, c, w in zip(ensemble.netB_list, cls_weight, cls_bias, weights.double()):
+            B, b = netB.bottleneck.weight.double(), netB.bottleneck.bias.double()
+            if netB.type == 'bn':
+                bn = netB.bn
+                scale = bn.weight.double() / torch.sqrt(bn.running_var.double() + bn.eps)
+                B = B * scale[:, None]
+                b = (b - bn.running_mean.double()) * scale + bn.bias.double()
+            blocks.append(w * torch.mm(C, B))
+            bias = bias + w * (torch.mv(C, b) + c)
+        weight = torch.cat(blocks, dim=1)
+        head = nn.Linear(weight.size(1), weight.size(0)).to(weights.device)
+        head.weight.copy_(weight)
+        head.bias.copy_(bias)
+    return head
+
+
+class FusedEnsemble(nn.Module):
+    # Source backbones followed by the fused head, logits of the weighted ensemble
+    def __init__(self, netF_list, head):
+        super(FusedEnsemble, self).__init__()
+        self.netF_list = nn.ModuleList(netF_list)
+        self.head = head
+
+    def forward(self, x):
+        return self.head(torch.cat([netF(x) for netF in self.netF_list], dim=1))
+
+
+def list_accuracy(fns, list_path, args):
+    # accuracy of every fn (normalized batch -> logits) over a labelled list, one pass over the images
+    dset = ImageList(open(list_path).readlines(), transform=ToUint8Array())
+    loader = DataLoader(dset, batch_size=args.batch_size, shuffle=False, collate_fn=BatchCrop(train=False),
+                        **runtime.loader_options(args))
+    correct = np.zeros(len(fns))
+    with torch.no_grad():
+        for inputs, labels in loader:
+            inputs = normalize_batch(inputs.to(args.device))
+            for i, fn in enumerate(fns):
+                correct[i] += (fn(inputs).argmax(dim=1).cpu() == labels).sum().item()
+    return correct / len(dset) * 100
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export an adapted CAiDA model with a fused classifier head')
+    parser.add_argument('--ckpt_dir', type=str, required=True, help="train_target_CAiDA.py output folder, e.g. ckps/MSFDA/office-31/D")
+    parser.add_argument('--savename', type=str, default='par_0.7_0.01', help="checkpoint suffix, par_<cls_par>_<crc_par>")
+    parser.add_argument('--output', type=str, default=None, help="export folder (default: --ckpt_dir)")
+    parser.add_argument('--net', type=str, default='resnet50', help="vgg16, resnet50, resnet101")
+    parser.add_argument('--layer', type=str, default="wn", choices=["linear", "wn"])
+    parser.add_argument('--classifier', type=str, default="bn", choices=["ori", "bn"])
+    parser.add_argument('--list', type=str, default=None, help="labelled image list to compare the accuracies on")
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--worker', type=int, default=4, help="number of workers")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--atol', type=float, default=1e-3, help="parity tolerance on the logits")
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--gpu_id', type=str, nargs='?', default='0', help="device id to run")
+    parser.add_argument('--device', type=str, default=None, help="cuda, cuda:<n> or cpu (default: cuda when available)")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads of the main process, 0 for the cores left over by the workers")
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    device = runtime.setup_device(args)
+    output = args.output or args.ckpt_dir
+    os.makedirs(output, exist_ok=True)
+
+    predictor = Predictor(args.ckpt_dir, args.savename, args.net, args.classifier, args.layer, args.device)
+    ensemble = predictor.ensemble
+    fused = FusedEnsemble(ensemble.netF_list, fuse_heads(ensemble, predictor.aggregator.weights)).eval()
+
+    def unfused(x):
+        # the cal_acc_multi / inference_pass path
+        _, _, outputs = ensemble(x)
+        return predictor.aggregator(outputs)[0]
+
+    x = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    with torch.no_grad():
+        ref = unfused(x)
+        scripted = torch.jit.trace(fused, x)
+        scripted = torch.jit.freeze(scripted)
+        outputs = {'fused': fused(x), 'torchscript': scripted(x)}
+    script_path = osp.join(output, 'target_' + args.savename + '.torchscript.pt')
+    scripted.save(script_path)
+    print('TorchScript: ' + script_path)
+
+    onnx_path = osp.join(output, 'target_' + args.savename + '.onnx')
+    try:
+        torch.onnx.export(fused, x, onnx_path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=args.opset)
+        print('ONNX: ' + onnx_path)
+    except Exception as e:
+        onnx_path = None
+        print('ONNX export failed: {}'.format(e))
+
+    session = None
+    if onnx_path is not None:
+        try:
+            import onnxruntime
+            providers = ['CUDAExecutionProvider'] if device.type == 'cuda' else ['CPUExecutionProvider']
+            session = onnxruntime.InferenceSession(onnx_path, providers=providers)
+            outputs['onnx'] = torch.from_numpy(session.run(None, {'input': x.cpu().numpy()})[0]).to(device)
+        except ImportError:
+            print('onnxruntime is not installed, skipping the ONNX parity and latency checks')
+
+    failed = False
+    for name, out in outputs.items():
+        diff = torch.max(torch.abs(out - ref)).item()
+        agree = torch.mean((out.argmax(1) == ref.argmax(1)).float()).item()
+        failed |= diff > args.atol
+        print('parity {}: max |logit diff| {:.2e}, top-1 agreement {:.2f}%'.format(name, diff, agree * 100))
+
+    with torch.no_grad():
+        times = {'unfused': timeit(lambda: unfused(x), device, args.repeat),
+                 'fused': timeit(lambda: fused(x), device, args.repeat),
+                 'torchscript': timeit(lambda: scripted(x), device, args.repeat)}
+    if session is not None:
+        x_np = x.cpu().numpy()
+        times['onnx'] = timeit(lambda: session.run(None, {'input': x_np}), torch.device('cpu'), args.repeat)
+    for name, t in times.items():
+        print('latency {}: {:.1f} ms/batch of {}, {:.2f}x'.format(name, t * 1000, args.batch_size, times['unfused'] / t))
+
+    if args.list is not None:
+        acc = list_accuracy([unfused, fused, scripted], args.list, args)
+        print('accuracy on {}: unfused {:.2f}%, fused {:.2f}%, torchscript {:.2f}%'.format(args.list, *acc))
+    if failed:
+        raise SystemExit('parity check failed: logits differ by more than --atol {}'.format(args.atol))
@@ -1,26 +1,87 @@
+import argparse
+import json
 import os
+import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
 
-dataset = 'office-31'
-dataset_path = './data'
-
-if dataset == 'office-31':
-    domains = ['amazon', 'dslr', 'webcam']
-elif dataset == 'office-caltech':
-    domains = ['amazon', 'dslr', 'webcam', 'caltech']
-elif dataset == 'office-home':
-    domains = ['Art', 'Clipart', 'Product', 'Real_World']
-else:
-    print('No such dataset exists!')
-
-for domain in domains:
-    log = open(dataset_path + '/' + dataset + '/' + domain + '_list.txt', 'w')
-    directory = os.path.join(dataset_path, dataset, domain)
-    classes = [x[1] for x in os.walk(directory)]
-    classes = classes[0]
-    classes.sort()
-    for idx, f in enumerate(classes):
-        files = os.listdir(dataset_path + '/' + dataset + '/' + domain + '/' + f)
-        for file in files:
-            s = os.path.join(dataset_path + '/' + dataset, domain, f, file) + ' ' + str(idx) + '\n'
-            log.write(s)
-    log.close()
+DOMAINS = {
+    'office-31': ['amazon', 'dslr', 'webcam'],
+    'office-caltech': ['amazon', 'dslr', 'webcam', 'caltech'],
+    'office-home': ['Art', 'Clipart', 'Product', 'Real_World'],
+    'domainnet': ['clipart', 'infograph', 'painting', 'quickdraw', 'real', 'sketch'],
+}
+MANIFEST = '.gen_list_manifest.json'
+
+
+def list_dirs(path):
+    with os.scandir(path) as it:
+        return sorted(entry.name for entry in it if entry.is_dir())
+
+
+def scan_class(path, cached):
+    # The directory is stat'ed before it is listed, so a change racing the scan
+    # leaves a stale key behind and is picked up by the next run.
+    st = os.stat(path)
+    key = [st.st_mtime_ns, st.st_size]
+    if cached is not None and cached['stat'] == key:
+        return cached, False
+    with os.scandir(path) as it:
+        files = sorted(entry.name for entry in it if entry.is_file())
+    return {'stat': key, 'files': files}, True
+
+
+def write_if_changed(path, text):
+    if osp.exists(path):
+        with open(path) as f:
+            if f.read() == text:
+                return False
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def gen_list(root, dset, domains, workers=16, full=False):
+    dset_dir = osp.join(root, dset)
+    manifest_path = osp.join(dset_dir, MANIFEST)
+    manifest = {}
+    if not full and osp.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    with ThreadPoolExecutor(workers) as pool:
+        classes = dict(zip(domains, pool.map(lambda d: list_dirs(osp.join(dset_dir, d)), domains)))
+        keys = [(d, c) for d in domains for c in classes[d]]
+        scans = pool.map(lambda k: scan_class(osp.join(dset_dir, k[0], k[1]), manifest.get(k[0] + '/' + k[1])), keys)
+        scans = dict(zip(keys, scans))
+
+    new_manifest = {}
+    for domain in domains:
+        lines = []
+        rescanned = 0
+        for idx, cls in enumerate(classes[domain]):
+            entry, changed = scans[(domain, cls)]
+            new_manifest[domain + '/' + cls] = entry
+            rescanned += changed
+            for name in entry['files']:
+                lines.append(osp.join(dset_dir, domain, cls, name) + ' ' + str(idx) + '\n')
+        written = write_if_changed(osp.join(dset_dir, domain + '_list.txt'), ''.join(lines))
+        print('{}: {} images, {} classes, {}/{} directories rescanned, list {}'.format(
+            domain, len(lines), len(classes[domain]), rescanned, len(classes[domain]),
+            'written' if written else 'unchanged'))
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(new_manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate <domain>_list.txt files')
+    parser.add_argument('--dset', type=str, default='office-31', choices=list(DOMAINS.keys()))
+    parser.add_argument('--root', type=str, default='./data', help="folder holding the datasets")
+    parser.add_argument('--domains', type=str, nargs='+', default=None, help="override the domains of --dset")
+    parser.add_argument('--workers', type=int, default=16, help="number of scanning threads")
+    parser.add_argument('--full', action='store_true', help="ignore the manifest and rescan every directory")
+    args = parser.parse_args()
+
+    gen_list(args.root, args.dset, args.domains or DOMAINS[args.dset], args.workers, args.full)
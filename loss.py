@@ -22,33 +22,19 @@ def KLConsistencyLoss(output, pred_label, args, temperature=2):
         args:   argments
     """
     eps = 1e-16
-    KL_loss = 0
+    output = output.float()
 
-    label_id = pred_label.cpu().numpy()
-    label_id = np.unique(label_id)
+    # class-mean logits of every source with one one-hot matmul, n x k(class) x k(logit)
+    onehot = F.one_hot(pred_label.view(-1), args.class_num).float()
+    cls_num = torch.sum(onehot, dim=0)
+    logits_cls = torch.einsum('bc,nbk->nck', onehot, output) / (cls_num + eps).view(1, -1, 1)
+    prob_cls_all = torch.clamp(torch.softmax(logits_cls, dim=2), 1e-8, 1.0)
+    log_prob_cls_all = torch.log(prob_cls_all)
 
-    for cls in range(args.class_num):
-        if cls in label_id:
-            prob_cls_all = torch.ones(len(args.src), args.class_num)
-
-            for i in range(len(args.src)):
-                mask_cls =  pred_label.cpu() == cls
-                mask_cls_ex = torch.repeat_interleave(mask_cls.unsqueeze(1), args.class_num, dim=1)
-
-                logits_cls = torch.sum(output[i] * mask_cls_ex.float(), dim=0)
-                cls_num = torch.sum(mask_cls)
-                logits_cls_acti = logits_cls * 1.0 / (cls_num + eps)
-                prob_cls = torch.softmax(logits_cls_acti, dim=0)
-                prob_cls = torch.clamp(prob_cls, 1e-8, 1.0)
-
-                prob_cls_all[i] = prob_cls
-
-
-            for m in range(len(args.src)):
-                for n in range(len(args.src)):
-                    KL_div = torch.sum(prob_cls_all[m] * torch.log(prob_cls_all[m] / prob_cls_all[n])) + \
-                              torch.sum(prob_cls_all[n] * torch.log(prob_cls_all[n] / prob_cls_all[m]))
-                    KL_loss += KL_div / 2
+    # symmetric KL of every source pair (m, n), n x n x k, summed over the classes present in the batch
+    KL_div = torch.sum((prob_cls_all.unsqueeze(1) - prob_cls_all.unsqueeze(0)) *
+                       (log_prob_cls_all.unsqueeze(1) - log_prob_cls_all.unsqueeze(0)), dim=3)
+    KL_loss = torch.sum(KL_div.sum(dim=(0, 1)) * (cls_num > 0).float()) / 2
 
     KL_loss = KL_loss / (args.class_num * len(args.src))
 
@@ -81,8 +67,7 @@ class CrossEntropyLabelSmooth(nn.Module):
             targets: ground truth labels with shape (num_classes)
         """
         log_probs = self.logsoftmax(inputs)
-        targets = torch.zeros(log_probs.size()).scatter_(1, targets.unsqueeze(1).cpu(), 1)
-        if self.use_gpu: targets = targets.cuda()
+        targets = torch.zeros_like(log_probs).scatter_(1, targets.unsqueeze(1), 1)
         targets = (1 - self.epsilon) * targets + self.epsilon / self.num_classes
         loss = (- targets * log_probs).sum(dim=1)
         if self.reduction:
@@ -5,9 +5,16 @@ import torchvision
 from torchvision import models
 from torch.autograd import Variable
 import math
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import torch.nn.utils.weight_norm as weightNorm
 from collections import OrderedDict
 
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    functional_call, vmap = None, None
+
 def calc_coeff(iter_num, high=1.0, low=0.0, alpha=10.0, max_iter=10000.0):
     return np.float(2.0 * (high - low) / (1.0 + np.exp(-alpha*iter_num / max_iter)) - (high - low) + low)
 
@@ -23,12 +30,25 @@ def init_weights(m):
         nn.init.xavier_normal_(m.weight)
         nn.init.zeros_(m.bias)
 
+def uninitialized(build, device):
+    """
+    build() without running any weight initialization (the parameters are created on the meta
+    device and then allocated on device), for modules whose weights are loaded from a checkpoint
+    right after. Falls back to a regular build() on torch versions without meta device support.
+    """
+    try:
+        with torch.device('meta'):
+            module = build()
+    except (AttributeError, TypeError, RuntimeError):
+        return build().to(device)
+    return module.to_empty(device=device)
+
 vgg_dict = {"vgg11":models.vgg11, "vgg13":models.vgg13, "vgg16":models.vgg16, "vgg19":models.vgg19, 
 "vgg11bn":models.vgg11_bn, "vgg13bn":models.vgg13_bn, "vgg16bn":models.vgg16_bn, "vgg19bn":models.vgg19_bn} 
 class VGGBase(nn.Module):
-  def __init__(self, vgg_name):
+  def __init__(self, vgg_name, pretrained=True):
     super(VGGBase, self).__init__()
-    model_vgg = vgg_dict[vgg_name](pretrained=True)
+    model_vgg = vgg_dict[vgg_name](pretrained=pretrained)
     self.features = model_vgg.features
     self.classifier = nn.Sequential()
     for i in range(6):
@@ -47,9 +67,9 @@ res_dict = {"resnet18":models.resnet18, "resnet34":models.resnet34, "resnet50":m
 "resnet101":models.resnet101, "resnet152":models.resnet152}
 
 class ResBase(nn.Module):
-    def __init__(self, res_name):
+    def __init__(self, res_name, pretrained=True):
         super(ResBase, self).__init__()
-        model_resnet = res_dict[res_name](pretrained=True)
+        model_resnet = res_dict[res_name](pretrained=pretrained)
         self.conv1 = model_resnet.conv1
         self.bn1 = model_resnet.bn1
         self.relu = model_resnet.relu
@@ -156,7 +176,7 @@ class scalar(nn.Module):
         self.w = nn.Parameter(torch.tensor(1.)*init_weights)   
     
     def forward(self,x):
-        x = self.w*torch.ones((x.shape[0]),1).cuda()
+        x = self.w*torch.ones((x.shape[0], 1), device=x.device)
         x = torch.sigmoid(x)
         return x
 
@@ -181,3 +201,132 @@ class source_quantizer(nn.Module):
         return x
 
 
+class SourceAggregator(object):
+    """
+    Source weights of the quantizer, computed once and applied to stacked source outputs.
+    Args:
+        netQ: source_quantizer, evaluated on the one-hot source representations
+        source_num: number of sources
+        renorm: how many times the weights are renormalized to sum to one
+    """
+    def __init__(self, netQ, source_num, renorm=1):
+        device = next(netQ.parameters()).device
+        weights = netQ(torch.eye(source_num, device=device)).view(-1)
+        for _ in range(renorm):
+            weights = weights / (torch.sum(weights) + 1e-16)
+        self.weights = weights
+
+    def __call__(self, *stacked):
+        # n x b x d_1, n x b x d_2, ... -> b x d_1, b x d_2, ... with one einsum
+        sizes = [x.shape[2] for x in stacked]
+        fused = torch.einsum('n,nbd->bd', self.weights, torch.cat(stacked, dim=2))
+        return fused.split(sizes, dim=1)
+
+    def reweight(self, outputs):
+        return outputs * self.weights.view(-1, 1, 1)
+
+
+class MultiSourceNet(nn.Module):
+    """
+    Runs the source models F -> B -> C of every source on the same batch.
+    Returns n x b x feature_dim, n x b x bottleneck_dim and n x b x class_num tensors
+    (source num x batch size). When batched, the parameters of the n sources are stacked
+    and each stage runs as one vmapped call instead of n separate ones; BatchNorm running
+    statistics are written back to the source modules afterwards. Every source shares the
+    train/eval mode of the first one.
+    With devices (one per source) source i is moved to devices[i] and the n stacks run
+    concurrently, one thread each; results are gathered on the device of the input.
+    """
+    def __init__(self, netF_list, netB_list, netC_list, batched=True, devices=None):
+        super(MultiSourceNet, self).__init__()
+        self.netF_list = nn.ModuleList(netF_list)
+        self.netB_list = nn.ModuleList(netB_list)
+        self.netC_list = nn.ModuleList(netC_list)
+        self.batched = batched and vmap is not None and devices is None
+        self.devices = devices
+        if devices is not None:
+            for i, device in enumerate(devices):
+                for net in [self.netF_list[i], self.netB_list[i], self.netC_list[i]]:
+                    net.to(device)
+            self.pool = ThreadPoolExecutor(len(devices))
+
+    def forward(self, x):
+        if self.devices is not None:
+            def source(i, x):
+                f = self.netF_list[i](x)
+                b = self.netB_list[i](f)
+                return f, b, self.netC_list[i](b)
+            return tuple(self._placed(source, [x] * len(self.devices)))
+        if self.batched:
+            features_F = self._vmap(self.netF_list, x, None)
+        else:
+            features_F = torch.stack([netF(x) for netF in self.netF_list])
+        features, outputs = self.forward_head(features_F)
+        return features_F, features, outputs
+
+    def forward_head(self, features_F):
+        if self.devices is not None:
+            def source(i, f):
+                b = self.netB_list[i](f)
+                return b, self.netC_list[i](b)
+            return tuple(self._placed(source, features_F))
+        if not self.batched:
+            features = torch.stack([netB(f) for netB, f in zip(self.netB_list, features_F)])
+            outputs = torch.stack([netC(f) for netC, f in zip(self.netC_list, features)])
+            return features, outputs
+        features = self._vmap(self.netB_list, features_F, 0)
+        weight, bias = self.classifier_weights()
+        outputs = torch.baddbmm(bias.unsqueeze(1), features, weight.transpose(1, 2))
+        return features, outputs
+
+    def classifier_weights(self):
+        # weightNorm is resolved explicitly instead of through its forward pre-hook
+        weights, biases = [], []
+        for netC in self.netC_list:
+            fc = netC.fc
+            if hasattr(fc, 'weight_g'):
+                weights.append(torch._weight_norm(fc.weight_v, fc.weight_g, 0))
+            else:
+                weights.append(fc.weight)
+            biases.append(fc.bias)
+        return torch.stack(weights), torch.stack(biases)
+
+    def _placed(self, fn, inputs):
+        # fn(i, inputs[i] moved to devices[i]) for every source in parallel. Grad mode and autocast
+        # are thread-local, so the worker threads take them over from the caller.
+        device = inputs[0].device
+        grad_enabled = torch.is_grad_enabled()
+        autocast = []
+        if torch.is_autocast_enabled():
+            autocast.append(('cuda', torch.get_autocast_gpu_dtype()))
+        if torch.is_autocast_cpu_enabled():
+            autocast.append(('cpu', torch.get_autocast_cpu_dtype()))
+
+        def run(i):
+            with torch.set_grad_enabled(grad_enabled), contextlib.ExitStack() as stack:
+                for device_type, dtype in autocast:
+                    stack.enter_context(torch.autocast(device_type, dtype=dtype))
+                outs = fn(i, inputs[i].to(self.devices[i]))
+            return [o.to(device) for o in outs]
+
+        results = list(self.pool.map(run, range(len(self.devices))))
+        return [torch.stack(outs) for outs in zip(*results)]
+
+    def _vmap(self, modules, x, in_dim):
+        named_params = [dict(m.named_parameters()) for m in modules]
+        named_buffers = [dict(m.named_buffers()) for m in modules]
+        params = {k: torch.stack([p[k] for p in named_params]) for k in named_params[0]}
+        buffers = {k: torch.stack([b[k] for b in named_buffers]) for k in named_buffers[0]}
+
+        def call(p, b, inputs):
+            return functional_call(modules[0], (p, b), (inputs,))
+
+        # 'different': every source draws its own dropout masks (VGGBase.classifier), as in the looped path
+        out = vmap(call, in_dims=(0, 0, in_dim), randomness='different')(params, buffers, x)
+        if not modules[0].training:
+            return out # BatchNorm statistics only change in train mode
+        with torch.no_grad():
+            for i, b in enumerate(named_buffers):
+                for k, v in b.items():
+                    v.copy_(buffers[k][i])
+        return out
@@ -0,0 +1,163 @@
+import argparse
+import glob
+import os
+import os.path as osp
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+import network, runtime
+from checkpoint import load_mmap
+from data_list import ImageList_idx, ToUint8Array, BatchCrop, normalize_batch
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class Predictor(object):
+    """
+    Adapted multi-source model of a train_target_CAiDA.py output folder (target_{F,B,C}_<i>_<savename>.pt
+    and target_Q_<savename>.pt), loaded once. Calling it on a batch of images (uint8 or normalized,
+    b x 3 x 224 x 224) returns the netQ-weighted logits (b x K) and bottleneck features (b x bottleneck_dim).
+    """
+    def __init__(self, ckpt_dir, savename, net='resnet50', classifier='bn', layer='wn', device='cpu', amp='off',
+                 channels_last=False):
+        self.device = torch.device(device)
+        self.amp = amp
+        self.channels_last = channels_last
+        source_num = len(glob.glob(osp.join(ckpt_dir, 'target_F_*_' + savename + '.pt')))
+        if source_num == 0:
+            raise FileNotFoundError('No target_F_*_{}.pt in {}'.format(savename, ckpt_dir))
+
+        def path(part, i=None):
+            name = 'target_' + part + ('_' + str(i) if i is not None else '') + '_' + savename + '.pt'
+            return osp.join(ckpt_dir, name)
+
+        netF_list, netB_list, netC_list = [], [], []
+        for i in range(source_num):
+            state_C = load_mmap(path('C', i))
+            class_num, bottleneck = state_C['fc.weight_v' if layer == 'wn' else 'fc.weight'].shape
+            if net[0:3] == 'res':
+                netF = network.uninitialized(lambda: network.ResBase(res_name=net, pretrained=False), self.device)
+            elif net[0:3] == 'vgg':
+                netF = network.uninitialized(lambda: network.VGGBase(vgg_name=net, pretrained=False), self.device)
+            netB = network.uninitialized(lambda: network.feat_bottleneck(
+                type=classifier, feature_dim=netF.in_features, bottleneck_dim=bottleneck), self.device)
+            netC = network.uninitialized(lambda: network.feat_classifier(
+                type=layer, class_num=class_num, bottleneck_dim=bottleneck), self.device)
+            netF.load_state_dict(load_mmap(path('F', i)))
+            netB.load_state_dict(load_mmap(path('B', i)))
+            netC.load_state_dict(state_C)
+            if channels_last:
+                netF = netF.to(memory_format=torch.channels_last)
+            netF_list.append(netF)
+            netB_list.append(netB)
+            netC_list.append(netC)
+        self.class_num = class_num
+
+        self.netQ = network.source_quantizer(source_num=source_num).to(self.device).eval()
+        self.netQ.load_state_dict(load_mmap(path('Q')))
+        # checkpoint files the model was loaded from
+        self.paths = [path(part, i) for i in range(source_num) for part in ['F', 'B', 'C']] + [path('Q')]
+        self.ensemble = network.MultiSourceNet(netF_list, netB_list, netC_list).eval()
+        with torch.no_grad():
+            self.aggregator = network.SourceAggregator(self.netQ, source_num) # the weights are fixed
+
+    def __call__(self, inputs):
+        inputs = runtime.channels_last(normalize_batch(inputs.to(self.device, non_blocking=True)), self.channels_last)
+        with torch.no_grad():
+            with runtime.autocast(self.device.type, self.amp):
+                _, features, outputs = self.ensemble(inputs)
+            return self.aggregator(outputs.float(), features.float())
+
+
+def read_inputs(path):
+    # image paths of a list file ("path [label ...]" lines) or of the images below a directory
+    if osp.isdir(path):
+        paths = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            paths += [osp.join(root, f) for f in sorted(files) if f.lower().endswith(IMG_EXTENSIONS)]
+        return paths
+    with open(path) as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+
+def predict(predictor, paths, args):
+    """
+    Streams paths through predictor and writes, into args.output:
+        predictions.txt: "path class probability" lines, appended every args.chunk images
+        probs.npy: num_image x K probabilities (memory-mapped, flushed every args.chunk images)
+        features.npy: num_image x bottleneck_dim weighted bottleneck features, with --features
+    """
+    os.makedirs(args.output, exist_ok=True)
+    dset = ImageList_idx(paths, labels=np.zeros(len(paths), dtype=np.int64), transform=ToUint8Array())
+    loader = DataLoader(dset, batch_size=args.batch_size, shuffle=False, drop_last=False,
+                        collate_fn=BatchCrop(train=False), **runtime.loader_options(args))
+
+    probs_out = np.lib.format.open_memmap(osp.join(args.output, 'probs.npy'), mode='w+', dtype=np.float32,
+                                          shape=(len(paths), predictor.class_num))
+    features_out = None
+    latencies, lines = [], []
+    start = time.perf_counter()
+    with open(osp.join(args.output, 'predictions.txt'), 'w') as pred_file:
+        for inputs, _, idx in loader:
+            tick = time.perf_counter()
+            outputs, features = predictor(inputs)
+            probs = torch.softmax(outputs, dim=1)
+            prob, pred = probs.max(dim=1)
+            probs, prob, pred = probs.cpu().numpy(), prob.cpu().numpy(), pred.cpu().numpy()
+            latencies.append(time.perf_counter() - tick)
+
+            idx = idx.numpy()
+            probs_out[idx] = probs
+            if args.features:
+                if features_out is None:
+                    features_out = np.lib.format.open_memmap(osp.join(args.output, 'features.npy'), mode='w+',
+                                                             dtype=np.float32, shape=(len(paths), features.size(1)))
+                features_out[idx] = features.cpu().numpy()
+            lines += ['{} {} {:.4f}\n'.format(paths[i], c, p) for i, c, p in zip(idx, pred, prob)]
+            if len(lines) >= args.chunk:
+                pred_file.writelines(lines)
+                lines = []
+                probs_out.flush()
+                if features_out is not None:
+                    features_out.flush()
+        pred_file.writelines(lines)
+    probs_out.flush()
+    if features_out is not None:
+        features_out.flush()
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    print('{} images in {:.1f} s: {:.1f} img/s, batch latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(
+        len(paths), elapsed, len(paths) / elapsed, *np.percentile(latencies, [50, 90, 99])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Predict with an adapted CAiDA model')
+    parser.add_argument('input', type=str, help="image list file or directory of images")
+    parser.add_argument('--ckpt_dir', type=str, required=True, help="train_target_CAiDA.py output folder, e.g. ckps/MSFDA/office-31/D")
+    parser.add_argument('--savename', type=str, default='par_0.7_0.01', help="checkpoint suffix, par_<cls_par>_<crc_par>")
+    parser.add_argument('--output', type=str, default='predictions')
+    parser.add_argument('--net', type=str, default='resnet50', help="vgg16, resnet50, resnet101")
+    parser.add_argument('--layer', type=str, default="wn", choices=["linear", "wn"])
+    parser.add_argument('--classifier', type=str, default="bn", choices=["ori", "bn"])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--worker', type=int, default=4, help="number of workers")
+    parser.add_argument('--chunk', type=int, default=4096, help="images between two writes of the outputs")
+    parser.add_argument('--features', action='store_true', help="also write the weighted bottleneck features")
+    parser.add_argument('--gpu_id', type=str, nargs='?', default='0', help="device id to run")
+    parser.add_argument('--device', type=str, default=None, help="cuda, cuda:<n> or cpu (default: cuda when available)")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads of the main process, 0 for the cores left over by the workers")
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--channels_last', action='store_true')
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    runtime.setup_device(args)
+    start = time.perf_counter()
+    predictor = Predictor(args.ckpt_dir, args.savename, args.net, args.classifier, args.layer, args.device,
+                          args.amp, args.channels_last)
+    print('Loaded {} in {:.1f} s'.format(args.ckpt_dir, time.perf_counter() - start))
+    predict(predictor, read_inputs(args.input), args)
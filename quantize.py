@@ -0,0 +1,134 @@
+import argparse
+import copy
+import os
+import os.path as osp
+import time
+from argparse import Namespace
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+import network, runtime
+from runtime import timeit
+from data_list import ImageList_idx, ToUint8Array, BatchCrop, normalize_batch
+from predict import Predictor
+from train_target_CAiDA import cal_acc_multi
+
+
+def quantize_backbone(netF, calib_loader, backend='x86'):
+    """
+    Static int8 post-training quantization of a backbone (ResBase) in FX graph mode: observers are
+    inserted after every conv/bn/relu block, calibrated on the images of calib_loader, and the
+    convolutions are converted to int8 kernels of backend (x86/fbgemm for x86 servers, qnnpack for arm).
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    torch.backends.quantized.engine = backend
+    example = torch.zeros(1, 3, 224, 224)
+    prepared = prepare_fx(copy.deepcopy(netF).eval(), get_default_qconfig_mapping(backend), example_inputs=(example,))
+    with torch.no_grad():
+        for inputs, _, _ in calib_loader:
+            prepared(normalize_batch(inputs))
+    return convert_fx(prepared)
+
+
+def plain_head(net):
+    # Fresh feat_bottleneck / feat_classifier with the weights of net and weightNorm folded into a plain
+    # Linear weight (g * v / ||v||). Weight-normed modules cannot be deep-copied: their weight is a
+    # non-leaf tensor recomputed by a forward pre-hook.
+    with torch.no_grad():
+        if isinstance(net, network.feat_classifier):
+            fc = net.fc
+            weight = torch._weight_norm(fc.weight_v, fc.weight_g, 0) if hasattr(fc, 'weight_g') else fc.weight
+            plain = network.uninitialized(lambda: network.feat_classifier(
+                class_num=weight.size(0), bottleneck_dim=weight.size(1), type='linear'), weight.device)
+            plain.fc.weight.copy_(weight)
+            plain.fc.bias.copy_(fc.bias)
+        else:
+            plain = network.uninitialized(lambda: network.feat_bottleneck(
+                feature_dim=net.bottleneck.in_features, bottleneck_dim=net.bottleneck.out_features, type=net.type),
+                net.bottleneck.weight.device)
+            plain.load_state_dict(net.state_dict())
+    return plain.eval()
+
+
+def quantize_head(net):
+    # Dynamic int8 quantization of the Linears (weights int8, activations quantized per batch at runtime)
+    return torch.ao.quantization.quantize_dynamic(plain_head(net), {nn.Linear}, dtype=torch.qint8)
+
+
+def evaluate(loader, ensemble, netQ, args):
+    # accuracy (cal_acc_multi) and end-to-end throughput of one pass over loader
+    start = time.perf_counter()
+    acc, _ = cal_acc_multi(loader, ensemble, netQ, args)
+    return acc, len(loader.dataset) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Int8 post-training quantization of an adapted CAiDA model')
+    parser.add_argument('--ckpt_dir', type=str, required=True, help="train_target_CAiDA.py output folder, e.g. ckps/MSFDA/office-31/D")
+    parser.add_argument('--savename', type=str, default='par_0.7_0.01', help="checkpoint suffix, par_<cls_par>_<crc_par>")
+    parser.add_argument('--list', type=str, required=True, help="target image list, e.g. data/office-31/dslr_list.txt")
+    parser.add_argument('--output', type=str, default=None, help="folder of the quantized models (default: --ckpt_dir)")
+    parser.add_argument('--net', type=str, default='resnet50', help="resnet18, resnet34, resnet50, resnet101")
+    parser.add_argument('--layer', type=str, default="wn", choices=["linear", "wn"])
+    parser.add_argument('--classifier', type=str, default="bn", choices=["ori", "bn"])
+    parser.add_argument('--calib', type=int, default=512, help="target images sampled for the calibration")
+    parser.add_argument('--backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--worker', type=int, default=4, help="number of workers")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=2022, help="random seed")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads of the main process, 0 for the cores left over by the workers")
+    args = parser.parse_args()
+
+    # int8 kernels run on the cpu only
+    args.device = 'cpu'
+    device = runtime.setup_device(args)
+    output = args.output or args.ckpt_dir
+    os.makedirs(output, exist_ok=True)
+
+    predictor = Predictor(args.ckpt_dir, args.savename, args.net, args.classifier, args.layer, 'cpu')
+    fp32 = predictor.ensemble
+    netQ = predictor.netQ
+
+    paths = open(args.list).readlines()
+    dset = ImageList_idx(paths, transform=ToUint8Array())
+    options = dict(batch_size=args.batch_size, shuffle=False, collate_fn=BatchCrop(train=False), **runtime.loader_options(args))
+    calib_idx = np.random.RandomState(args.seed).permutation(len(dset))[:args.calib]
+    calib_loader = DataLoader(Subset(dset, calib_idx), **options)
+    test_loader = DataLoader(dset, **options)
+
+    start = time.perf_counter()
+    netF_list = [quantize_backbone(netF, calib_loader, args.backend) for netF in fp32.netF_list]
+    netB_list = [quantize_head(netB) for netB in fp32.netB_list]
+    netC_list = [quantize_head(netC) for netC in fp32.netC_list]
+    print('Quantized {} sources, calibrated on {} images, in {:.1f} s'.format(
+        len(netF_list), len(calib_idx), time.perf_counter() - start))
+
+    # TorchScript, the quantized modules cannot be rebuilt from a state dict without the calibration
+    x = normalize_batch(next(iter(test_loader))[0])
+    with torch.no_grad():
+        for i, nets in enumerate(zip(netF_list, netB_list, netC_list)):
+            f = x
+            for part, net in zip(['F', 'B', 'C'], nets):
+                path = osp.join(output, 'int8_' + part + '_' + str(i) + '_' + args.savename + '.pt')
+                torch.jit.trace(net, f).save(path)
+                f = net(f)
+    print('Saved int8_{{F,B,C}}_<i>_{}.pt to {}'.format(args.savename, output))
+
+    # the same looped MultiSourceNet for both, so that only the precision differs
+    eval_args = Namespace(device='cpu', amp='off', channels_last=False, distributed=False, freeze_backbone=False,
+                          src=[None] * len(netF_list))
+    models = {'fp32': network.MultiSourceNet(fp32.netF_list, fp32.netB_list, fp32.netC_list, batched=False).eval(),
+              'int8': network.MultiSourceNet(netF_list, netB_list, netC_list, batched=False).eval()}
+    results = {}
+    for name, ensemble in models.items():
+        acc, img_s = evaluate(test_loader, ensemble, netQ, eval_args)
+        with torch.no_grad():
+            batch_time = timeit(lambda: ensemble(x), device, args.repeat)
+        results[name] = (acc, img_s, x.size(0) / batch_time)
+    for name, (acc, img_s, model_img_s) in results.items():
+        print('{}: accuracy {:.2f}%, {:.1f} img/s end to end, {:.1f} img/s model only ({:.2f}x)'.format(
+            name, acc, img_s, model_img_s, model_img_s / results['fp32'][2]))
@@ -0,0 +1,169 @@
+import contextlib
+import os
+import time
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(device_type, amp):
+    # Mixed precision for the network forward passes only. Losses, entropies, the source_quantizer
+    # weights and the pseudo-label clustering are computed in fp32 outside of it.
+    if amp == 'off':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=AMP_DTYPES[amp])
+
+
+def grad_scaler(device_type, amp):
+    # fp16 needs loss scaling, bf16 has the exponent range of fp32 and does not
+    enabled = amp == 'fp16'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def setup_device(args):
+    """
+    Resolve --device (cuda when available) and size the intra-op thread pool of the main process
+    against the DataLoader workers, so that workers and threads together cover the cores of the
+    machine without oversubscribing them.
+    Under torchrun (WORLD_SIZE > 1) this also joins the process group, with nccl on cuda and gloo
+    on cpu; each rank gets the gpu of its LOCAL_RANK and its share of the cores.
+    """
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.distributed = args.world_size > 1
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+    args.device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.distributed and args.device == 'cuda':
+        args.device = 'cuda:' + os.environ.get('LOCAL_RANK', '0')
+    device = torch.device(args.device)
+    if device.type == 'cuda' and device.index is not None:
+        torch.cuda.set_device(device)
+    cores = (os.cpu_count() or 1) // local_world_size
+    torch.set_num_threads(args.threads or max(1, cores - args.worker))
+
+    if args.distributed and not dist.is_initialized():
+        dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo')
+    return device
+
+
+def is_main(args):
+    return getattr(args, 'rank', 0) == 0
+
+
+class ShardSampler(Sampler):
+    # Strided shard of the dataset for evaluation, without the padding (duplicated samples) of DistributedSampler
+    def __init__(self, dataset, rank, world_size):
+        self.indices = range(rank, len(dataset), world_size)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def train_sampler(dataset, args):
+    # None means a plain shuffling DataLoader
+    return DistributedSampler(dataset, shuffle=True) if args.distributed else None
+
+
+def eval_sampler(dataset, args):
+    return ShardSampler(dataset, args.rank, args.world_size) if args.distributed else None
+
+
+def all_gather_rows(*rows):
+    """
+    Concatenation over all ranks of each of rows (tensors with the same number of rows on a rank,
+    which may differ between ranks: shards are zero-padded to the longest one for all_gather).
+    """
+    comm_device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    world_size = dist.get_world_size()
+    count = torch.tensor([rows[0].size(0)], device=comm_device)
+    counts = [torch.zeros_like(count) for _ in range(world_size)]
+    dist.all_gather(counts, count)
+    counts = [c.item() for c in counts]
+    size = max(counts)
+
+    gathered = []
+    for x in rows:
+        pad = x.new_zeros((size - x.size(0),) + x.shape[1:])
+        local = torch.cat([x, pad]).to(comm_device)
+        out = [torch.empty_like(local) for _ in range(world_size)]
+        dist.all_gather(out, local)
+        gathered.append(torch.cat([o[:c] for o, c in zip(out, counts)]).to(x.device))
+    return gathered
+
+
+def all_reduce_grads(optimizer):
+    # Average the gradients over all ranks, for models that are not wrapped in DistributedDataParallel
+    grads = [p.grad for group in optimizer.param_groups for p in group['params'] if p.grad is not None]
+    if not grads:
+        return
+    flat = torch._utils._flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for grad, synced in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+        grad.copy_(synced)
+
+
+def broadcast_modules(modules, buffers_only=False):
+    # Copy the parameters and/or buffers (BatchNorm statistics) of rank 0 to all ranks
+    with torch.no_grad():
+        for module in modules:
+            tensors = list(module.buffers()) if buffers_only else list(module.parameters()) + list(module.buffers())
+            for x in tensors:
+                dist.broadcast(x.data, 0)
+
+
+def worker_init(worker_id):
+    # DataLoader workers decode and augment single samples, one intra-op thread each is enough
+    torch.set_num_threads(1)
+
+
+def loader_options(args, persistent=True):
+    # DataLoader workers keep prefetch_factor batches each in flight and, when persistent, stay alive
+    # across epochs; batches go to page-locked memory when they are copied to a gpu (with non_blocking=True).
+    # Only the training loader should be persistent: the thread budget of setup_device counts one worker pool.
+    options = dict(num_workers=args.worker, worker_init_fn=worker_init,
+                   pin_memory=torch.device(args.device).type == 'cuda')
+    if args.worker > 0:
+        options.update(persistent_workers=persistent, prefetch_factor=4)
+    return options
+
+
+def epochs(loader):
+    # Endless stream of the batches of loader, epoch after epoch; DistributedSampler is reshuffled every epoch
+    epoch = 0
+    while True:
+        if isinstance(loader.sampler, DistributedSampler):
+            loader.sampler.set_epoch(epoch)
+        for batch in loader:
+            yield batch
+        epoch += 1
+
+
+def channels_last(x, enabled):
+    # NHWC layout for image batches, anything else (e.g. cached features) is left alone
+    if enabled and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def timeit(fn, device, repeat=10, warmup=3):
+    # mean seconds per call of fn after warmup calls, synchronizing cuda around the timed loop
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
@@ -6,16 +6,15 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
 from torchvision import transforms
-import network, loss
+import network, loss, runtime
+from checkpoint import AsyncCheckpointWriter, load_mmap
 from torch.utils.data import DataLoader
-from data_list import ImageList
-import random, pdb, math, copy
-from tqdm import tqdm
+from torch.nn.parallel import DistributedDataParallel
+from data_list import ImageList, LazyLoaders, ensure_image_cache, ToUint8Array, BatchCrop, normalize_batch
+import random, pdb, math, copy, time
 from loss import CrossEntropyLabelSmooth
-from scipy.spatial.distance import cdist
-from sklearn.metrics import confusion_matrix
-from sklearn.cluster import KMeans
 import warnings
 
 warnings.filterwarnings('ignore')
@@ -68,11 +67,10 @@ def image_test(resize_size=256, crop_size=224, alexnet=False):
 
 def data_load(args):
     ## prepare data
-    dsets = {}
-    dset_loaders = {}
+    # loaders (and their image caches) are only built on first use, test_target just needs "test"
+    dset_loaders = LazyLoaders()
     train_bs = args.batch_size
     txt_src = open(args.s_dset_path).readlines()
-    txt_test = open(args.test_dset_path).readlines()
 
     if args.trte == "val":
         dsize = len(txt_src)
@@ -85,20 +83,42 @@ def data_load(args):
         _, te_txt = torch.utils.data.random_split(txt_src, [tr_size, dsize - tr_size])
         tr_txt = txt_src
 
-    dsets["source_tr"] = ImageList(tr_txt, transform=image_train())
-    dset_loaders["source_tr"] = DataLoader(dsets["source_tr"], batch_size=train_bs, shuffle=True,
-                                           num_workers=args.worker, drop_last=False)
-    dsets["source_te"] = ImageList(te_txt, transform=image_test())
-    dset_loaders["source_te"] = DataLoader(dsets["source_te"], batch_size=train_bs, shuffle=True,
-                                           num_workers=args.worker, drop_last=False)
-    dsets["test"] = ImageList(txt_test, transform=image_test())
-    dset_loaders["test"] = DataLoader(dsets["test"], batch_size=train_bs * 2, shuffle=True, num_workers=args.worker,
-                                      drop_last=False)
+    def cache(list_path):
+        return ensure_image_cache(list_path, args.cache_dir) if args.cache else None
 
+    if args.batch_aug:
+        # uint8 samples, crop/flip at collate time, normalization on the device
+        tr_transform, te_transform = ToUint8Array(), ToUint8Array()
+        tr_collate, te_collate = BatchCrop(train=True), BatchCrop(train=False)
+    else:
+        tr_transform, te_transform = image_train(), image_test()
+        tr_collate, te_collate = None, None
+
+    # under torchrun every rank trains on a DistributedSampler shard and evaluates a ShardSampler shard
+    def source_tr():
+        dset = ImageList(tr_txt, transform=tr_transform, cache=cache(args.s_dset_path))
+        sampler = runtime.train_sampler(dset, args)
+        return DataLoader(dset, batch_size=train_bs, shuffle=sampler is None, sampler=sampler, drop_last=False,
+                          collate_fn=tr_collate, **runtime.loader_options(args))
+
+    def source_te():
+        dset = ImageList(te_txt, transform=te_transform, cache=cache(args.s_dset_path))
+        return DataLoader(dset, batch_size=train_bs, shuffle=False, sampler=runtime.eval_sampler(dset, args),
+                          drop_last=False, collate_fn=te_collate, **runtime.loader_options(args, persistent=False))
+
+    def test():
+        dset = ImageList(open(args.test_dset_path).readlines(), transform=te_transform,
+                         cache=cache(args.test_dset_path))
+        return DataLoader(dset, batch_size=train_bs * 2, shuffle=False, sampler=runtime.eval_sampler(dset, args),
+                          drop_last=False, collate_fn=te_collate, **runtime.loader_options(args, persistent=False))
+
+    dset_loaders.register("source_tr", source_tr)
+    dset_loaders.register("source_te", source_te)
+    dset_loaders.register("test", test)
     return dset_loaders
 
 
-def cal_acc(loader, netF, netB, netC, flag=False):
+def cal_acc(loader, netF, netB, netC, args, flag=False):
     start_test = True
     with torch.no_grad():
         iter_test = iter(loader)
@@ -106,8 +126,9 @@ def cal_acc(loader, netF, netB, netC, flag=False):
             data = next(iter_test)
             inputs = data[0]
             labels = data[1]
-            inputs = inputs.cuda()
-            outputs = netC(netB(netF(inputs)))
+            inputs = runtime.channels_last(normalize_batch(inputs.to(args.device, non_blocking=True)), args.channels_last)
+            with runtime.autocast(inputs.device.type, args.amp):
+                outputs = netC(netB(netF(inputs)))
             if start_test:
                 all_output = outputs.float().cpu()
                 all_label = labels.float()
@@ -115,6 +136,8 @@ def cal_acc(loader, netF, netB, netC, flag=False):
             else:
                 all_output = torch.cat((all_output, outputs.float().cpu()), 0)
                 all_label = torch.cat((all_label, labels.float()), 0)
+    if args.distributed:
+        all_output, all_label = runtime.all_gather_rows(all_output, all_label)
 
     all_output = nn.Softmax(dim=1)(all_output)
     _, predict = torch.max(all_output, 1)
@@ -122,6 +145,7 @@ def cal_acc(loader, netF, netB, netC, flag=False):
     mean_ent = torch.mean(loss.Entropy(all_output)).cpu().data.item()
 
     if flag:
+        from sklearn.metrics import confusion_matrix
         matrix = confusion_matrix(all_label, torch.squeeze(predict).float())
         acc = matrix.diagonal() / matrix.sum(axis=1) * 100
         aacc = acc.mean()
@@ -136,13 +160,20 @@ def train_source(args):
     dset_loaders = data_load(args)
     ## set base network
     if args.net[0:3] == 'res':
-        netF = network.ResBase(res_name=args.net).cuda()
+        netF = network.ResBase(res_name=args.net).to(args.device)
     elif args.net[0:3] == 'vgg':
-        netF = network.VGGBase(vgg_name=args.net).cuda()
+        netF = network.VGGBase(vgg_name=args.net).to(args.device)
 
     netB = network.feat_bottleneck(type=args.classifier, feature_dim=netF.in_features,
-                                   bottleneck_dim=args.bottleneck).cuda()
-    netC = network.feat_classifier(type=args.layer, class_num=args.class_num, bottleneck_dim=args.bottleneck).cuda()
+                                   bottleneck_dim=args.bottleneck).to(args.device)
+    netC = network.feat_classifier(type=args.layer, class_num=args.class_num,
+                                   bottleneck_dim=args.bottleneck).to(args.device)
+    if args.channels_last:
+        netF = netF.to(memory_format=torch.channels_last)
+    model = nn.Sequential(netF, netB, netC)
+    if args.distributed:
+        device = torch.device(args.device)
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
 
     param_group = []
     learning_rate = args.lr
@@ -154,17 +185,21 @@ def train_source(args):
         param_group += [{'params': v, 'lr': learning_rate}]
     optimizer = optim.SGD(param_group)
     optimizer = op_copy(optimizer)
+    scaler = runtime.grad_scaler(torch.device(args.device).type, args.amp)
 
     acc_init = 0
+    writer = AsyncCheckpointWriter()
+    from tqdm import tqdm
     # max_iter = args.max_epoch * len(dset_loaders["source_tr"])
     max_iter = 5
     # interval_iter = max_iter // 10
     interval_iter = 1
     iter_num = 0
-    print('-' * 100)
-    print('Start Training')
-    print('Max Iteration:', max_iter, 'Interval Iteration:', interval_iter)
-    print('-' * 100)
+    if runtime.is_main(args):
+        print('-' * 100)
+        print('Start Training')
+        print('Max Iteration:', max_iter, 'Interval Iteration:', interval_iter)
+        print('-' * 100)
 
     netF.train()
     netB.train()
@@ -182,44 +217,55 @@ def train_source(args):
         #     continue
 
         iter_num += 1
-        print(f'Iter {iter_num}/{max_iter}')
-        for inputs_source, labels_source in tqdm(dset_loaders["source_tr"]):
+        if runtime.is_main(args):
+            print(f'Iter {iter_num}/{max_iter}')
+        if args.distributed:
+            dset_loaders["source_tr"].sampler.set_epoch(iter_num)
+        num_img, tick = 0, time.perf_counter()
+        for inputs_source, labels_source in tqdm(dset_loaders["source_tr"], disable=not runtime.is_main(args)):
             lr_scheduler(optimizer, iter_num=iter_num, max_iter=max_iter)
 
-            inputs_source, labels_source = inputs_source.cuda(), labels_source.cuda()  # batch*3*224*224, batch*1
-            outputs_source = netF(inputs_source)  # batch*2048
-            outputs_source = netB(outputs_source)  # batch*256
-            outputs_source = netC(outputs_source)  # batch*31
-            classifier_loss = CrossEntropyLabelSmooth(num_classes=args.class_num, epsilon=args.smooth)(outputs_source,
-                                                                                                       labels_source)
+            inputs_source = normalize_batch(inputs_source.to(args.device, non_blocking=True))  # batch*3*224*224
+            labels_source = labels_source.to(args.device, non_blocking=True)  # batch*1
+            inputs_source = runtime.channels_last(inputs_source, args.channels_last)
+            with runtime.autocast(inputs_source.device.type, args.amp):
+                outputs_source = model(inputs_source)  # netF: batch*2048, netB: batch*256, netC: batch*31
+            classifier_loss = CrossEntropyLabelSmooth(num_classes=args.class_num, epsilon=args.smooth)(
+                outputs_source.float(), labels_source)
 
             optimizer.zero_grad()
-            classifier_loss.backward()
-            optimizer.step()
+            scaler.scale(classifier_loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            num_img += labels_source.size(0)
+        throughput = num_img * args.world_size / (time.perf_counter() - tick)
 
         if iter_num % interval_iter == 0 or iter_num == max_iter:
             netF.eval()
             netB.eval()
             netC.eval()
-            acc_s_te, _ = cal_acc(dset_loaders['source_te'], netF, netB, netC, False)
-            log_str = 'Task: {}, Iter:{}/{}; Accuracy = {:.2f}%'.format(args.name_src, iter_num, max_iter, acc_s_te)
+            acc_s_te, _ = cal_acc(dset_loaders['source_te'], netF, netB, netC, args, False)
+            log_str = 'Task: {}, Iter:{}/{}; Accuracy = {:.2f}%; Throughput = {:.1f} img/s ({})'.format(
+                args.name_src, iter_num, max_iter, acc_s_te, throughput, args.amp)
             args.out_file.write(log_str + '\n')
             args.out_file.flush()
-            print(log_str + '\n')
+            if runtime.is_main(args):
+                print(log_str + '\n')
 
             if acc_s_te >= acc_init:
                 acc_init = acc_s_te
-                best_netF = netF.state_dict()
-                best_netB = netB.state_dict()
-                best_netC = netC.state_dict()
+                if runtime.is_main(args):
+                    writer.save({osp.join(args.output_dir_src, "source_F.pt"): netF,
+                                 osp.join(args.output_dir_src, "source_B.pt"): netB,
+                                 osp.join(args.output_dir_src, "source_C.pt"): netC})
 
             netF.train()
             netB.train()
             netC.train()
 
-    torch.save(best_netF, osp.join(args.output_dir_src, "source_F.pt"))
-    torch.save(best_netB, osp.join(args.output_dir_src, "source_B.pt"))
-    torch.save(best_netC, osp.join(args.output_dir_src, "source_C.pt"))
+    writer.close()
+    if args.distributed:
+        dist.barrier() # the other ranks reload these checkpoints in test_target
 
     return netF, netB, netC
 
@@ -227,31 +273,36 @@ def train_source(args):
 def test_target(args):
     dset_loaders = data_load(args)
     ## set base network
+    # the weights come from the source checkpoints: no ImageNet weights, no initialization
     if args.net[0:3] == 'res':
-        netF = network.ResBase(res_name=args.net).cuda()
+        netF = network.uninitialized(lambda: network.ResBase(res_name=args.net, pretrained=False), args.device)
     elif args.net[0:3] == 'vgg':
-        netF = network.VGGBase(vgg_name=args.net).cuda()
+        netF = network.uninitialized(lambda: network.VGGBase(vgg_name=args.net, pretrained=False), args.device)
 
-    netB = network.feat_bottleneck(type=args.classifier, feature_dim=netF.in_features,
-                                   bottleneck_dim=args.bottleneck).cuda()
-    netC = network.feat_classifier(type=args.layer, class_num=args.class_num, bottleneck_dim=args.bottleneck).cuda()
+    netB = network.uninitialized(lambda: network.feat_bottleneck(
+        type=args.classifier, feature_dim=netF.in_features, bottleneck_dim=args.bottleneck), args.device)
+    netC = network.uninitialized(lambda: network.feat_classifier(
+        type=args.layer, class_num=args.class_num, bottleneck_dim=args.bottleneck), args.device)
 
     args.modelpath = args.output_dir_src + '/source_F.pt'
-    netF.load_state_dict(torch.load(args.modelpath))
+    netF.load_state_dict(load_mmap(args.modelpath))
     args.modelpath = args.output_dir_src + '/source_B.pt'
-    netB.load_state_dict(torch.load(args.modelpath))
+    netB.load_state_dict(load_mmap(args.modelpath))
     args.modelpath = args.output_dir_src + '/source_C.pt'
-    netC.load_state_dict(torch.load(args.modelpath))
+    netC.load_state_dict(load_mmap(args.modelpath))
+    if args.channels_last:
+        netF = netF.to(memory_format=torch.channels_last)
     netF.eval()
     netB.eval()
     netC.eval()
 
-    acc, _ = cal_acc(dset_loaders['test'], netF, netB, netC, False)
+    acc, _ = cal_acc(dset_loaders['test'], netF, netB, netC, args, False)
     log_str = '\nTraining: {}, Task: {}, Accuracy = {:.2f}%'.format(args.trte, args.name, acc)
 
     args.out_file.write(log_str)
     args.out_file.flush()
-    print(log_str)
+    if runtime.is_main(args):
+        print(log_str)
 
 
 def print_args(args):
@@ -261,7 +312,7 @@ def print_args(args):
     return s
 
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser(description='CAiDA')
     parser.add_argument('--gpu_id', type=str, nargs='?', default='0', help="device id to run")
     parser.add_argument('--s', type=int, default=0, help="source")
@@ -280,8 +331,19 @@ if __name__ == "__main__":
     parser.add_argument('--smooth', type=float, default=0.1)
     parser.add_argument('--output', type=str, default='ckps\\source')
     parser.add_argument('--trte', type=str, default='val', choices=['full', 'val'])
-    args = parser.parse_args()
-
+    parser.add_argument('--cache', action='store_true', help="read images from a pre-decoded memory-mapped cache")
+    parser.add_argument('--cache_dir', type=str, default=None, help="where to keep image caches (default: next to the lists)")
+    parser.add_argument('--batch_aug', action='store_true', help="load uint8 images, crop/flip per batch and normalize on the device")
+    parser.add_argument('--device', type=str, default=None, help="cuda, cuda:<n> or cpu (default: cuda when available)")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads of the main process, 0 for the cores left over by the workers")
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'], help="mixed precision for the network forward passes")
+    parser.add_argument('--channels_last', action='store_true', help="run the backbone in NHWC memory layout")
+    return parser
+
+
+def dset_names(args):
+    # domain names of args.dset, sets args.class_num
     if args.dset == 'office-home':
         names = ['Art', 'Clipart', 'Product', 'Real_World']
         args.class_num = 65
@@ -293,8 +355,11 @@ if __name__ == "__main__":
         args.class_num = 10
     else:
         raise ValueError('Dataset cannot be recognized. Please define your own dataset path.')
+    return names
 
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+
+def run_source(args, names):
+    # Train source domain args.s and test it on every other domain, after runtime.setup_device(args)
     SEED = args.seed
     torch.manual_seed(SEED)
     torch.cuda.manual_seed(SEED)
@@ -316,13 +381,15 @@ if __name__ == "__main__":
     if not osp.exists(args.output_dir_src):
         os.mkdir(args.output_dir_src)
 
-    args.out_file = open(osp.join(args.output_dir_src, 'log.txt'), 'w', encoding='utf-8')
+    # only rank 0 writes logs under torchrun
+    log_dir = args.output_dir_src if runtime.is_main(args) else None
+    args.out_file = open(osp.join(log_dir, 'log.txt') if log_dir else os.devnull, 'w', encoding='utf-8')
     args.out_file.write(print_args(args) + '\n')
     args.out_file.flush()
 
     train_source(args)
 
-    args.out_file = open(osp.join(args.output_dir_src, 'log_test.txt'), 'w', encoding='utf-8')
+    args.out_file = open(osp.join(log_dir, 'log_test.txt') if log_dir else os.devnull, 'w', encoding='utf-8')
     for i in range(len(names)):
         if i == args.s:
             continue  # first as domain, second as target
@@ -334,3 +401,12 @@ if __name__ == "__main__":
         args.test_dset_path = osp.join(folder, args.dset, names[args.t] + '_list.txt')
 
         test_target(args)
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    names = dset_names(args)
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    runtime.setup_device(args)
+    run_source(args, names)
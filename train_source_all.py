@@ -0,0 +1,81 @@
+import argparse
+import copy
+import os
+import os.path as osp
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import runtime
+import train_source
+from data_list import ensure_image_cache
+from checkpoint import consolidate_sources
+
+
+def run_job(args, names):
+    # One train_source.py run in a pool process
+    start = time.perf_counter()
+    runtime.setup_device(args)
+    train_source.run_source(args, names)
+    return args.s, time.perf_counter() - start
+
+
+def run_jobs(args, names, sources, jobs, devices):
+    # Trains sources with up to jobs concurrent processes; returns the wall-clock time and the threads per job.
+    # Every job gets an equal share of the cores: its DataLoader workers plus its intra-op threads
+    threads = args.threads or max(1, (os.cpu_count() or 1) // jobs - args.worker)
+    start = time.perf_counter()
+    # spawn: the jobs initialize cuda and their own thread pools
+    with ProcessPoolExecutor(jobs, mp_context=mp.get_context('spawn')) as pool:
+        futures = []
+        for k, s in enumerate(sources):
+            job_args = copy.copy(args)
+            job_args.s = s
+            job_args.t = (s + 1) % len(names)
+            job_args.device = devices[k % len(devices)]
+            job_args.threads = threads
+            futures.append(pool.submit(run_job, job_args, names))
+        for future in as_completed(futures):
+            s, elapsed = future.result()
+            print('Source {}: {:.1f} s'.format(names[s], elapsed))
+    return time.perf_counter() - start, threads
+
+
+def train_all(args):
+    names = train_source.dset_names(args)
+    sources = args.sources if args.sources is not None else list(range(len(names)))
+    jobs = max(1, min(args.jobs, len(sources)))
+    devices = args.devices or [args.device]
+
+    if args.cache:
+        # decode every domain once up front, the jobs then share the memory-mapped caches
+        for name in names:
+            ensure_image_cache(osp.join('data', args.dset, name + '_list.txt'), args.cache_dir)
+
+    serial = None
+    if args.baseline:
+        # the same jobs one after another, each with the whole machine, on the first device
+        serial, _ = run_jobs(args, names, sources, 1, devices[:1])
+        print('Serial baseline: {:.1f} s'.format(serial))
+    wall, threads = run_jobs(args, names, sources, jobs, devices)
+    print('Consolidated source checkpoints: ' + consolidate_sources(osp.join('ckps', 'source', args.dset)))
+
+    log_str = '{} sources, {} jobs x ({} workers + {} threads): wall-clock {:.1f} s'.format(
+        len(sources), jobs, args.worker, threads, wall)
+    if serial is not None:
+        log_str += ', serial {:.1f} s, speedup {:.2f}x'.format(serial, serial / wall)
+    print(log_str)
+
+
+if __name__ == "__main__":
+    parser = train_source.build_parser()
+    parser.description = 'Train the source models of every domain of a dataset concurrently'
+    parser.add_argument('--sources', type=int, nargs='+', default=None, help="source domains to train (default: all)")
+    parser.add_argument('--jobs', type=int, default=2, help="concurrent training processes")
+    parser.add_argument('--devices', type=str, nargs='+', default=None,
+                        help="devices assigned to the jobs round robin (default: --device)")
+    parser.add_argument('--baseline', action='store_true',
+                        help="first train the sources one after another to measure the speedup against a serial run")
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    train_all(args)
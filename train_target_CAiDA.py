@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import os, sys
 import os.path as osp
 import torchvision
@@ -7,15 +8,16 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from numpy import linalg as LA
+import torch.distributed as dist
 from torchvision import transforms
-import network, loss
-from torch.utils.data import DataLoader
-from data_list import ImageList, ImageList_idx
+import network, loss, anchor_index, runtime
+from checkpoint import AsyncCheckpointWriter, SourceCheckpoints
+from torch.utils.data import DataLoader, TensorDataset
+from data_list import ImageList, ImageList_idx, LazyLoaders, ensure_image_cache, ToUint8Array, BatchCrop, normalize_batch
 import random, pdb, math, copy
-from tqdm import tqdm
-from scipy.spatial.distance import cdist
-from sklearn.metrics import confusion_matrix
+import time
+
+START_TIME = time.perf_counter() # benchmark.py startup times the imports
 
 
 def op_copy(optimizer):
@@ -61,60 +63,161 @@ def image_test(resize_size=256, crop_size=224, alexnet=False):
 
 def data_load(args):
     ## prepare data
-    dsets = {}
-    dset_loaders = {}
+    # loaders (and their image caches) are only built on first use
+    dset_loaders = LazyLoaders()
     train_bs = args.batch_size
-    txt_tar = open(args.t_dset_path).readlines()
-    txt_test = open(args.test_dset_path).readlines()
 
-    dsets["target"] = ImageList_idx(txt_tar, transform=image_train())
-    dset_loaders["target"] = DataLoader(dsets["target"], batch_size=train_bs, shuffle=True, num_workers=args.worker,
-                                        drop_last=False)
-    dsets['target_'] = ImageList_idx(txt_tar, transform=image_train())
-    dset_loaders['target_'] = DataLoader(dsets['target_'], batch_size=train_bs * 3, shuffle=False,
-                                         num_workers=args.worker, drop_last=False)
-    dsets["test"] = ImageList_idx(txt_test, transform=image_test())
-    dset_loaders["test"] = DataLoader(dsets["test"], batch_size=train_bs * 3, shuffle=False, num_workers=args.worker,
-                                      drop_last=False)
+    def cache(list_path):
+        return ensure_image_cache(list_path, args.cache_dir) if args.cache else None
+
+    if args.batch_aug:
+        # uint8 samples, crop/flip at collate time, normalization on the device
+        tr_transform, te_transform = ToUint8Array(), ToUint8Array()
+        tr_collate, te_collate = BatchCrop(train=True), BatchCrop(train=False)
+    else:
+        tr_transform, te_transform = image_train(), image_test()
+        tr_collate, te_collate = None, None
+
+    # under torchrun every rank trains on a DistributedSampler shard and runs inference on a ShardSampler shard
+    def target():
+        dset = ImageList_idx(open(args.t_dset_path).readlines(), transform=tr_transform, cache=cache(args.t_dset_path))
+        sampler = runtime.train_sampler(dset, args)
+        return DataLoader(dset, batch_size=train_bs, shuffle=sampler is None, sampler=sampler, drop_last=False,
+                          collate_fn=tr_collate, **runtime.loader_options(args))
+
+    def test():
+        dset = ImageList_idx(open(args.test_dset_path).readlines(), transform=te_transform,
+                             cache=cache(args.test_dset_path))
+        return DataLoader(dset, batch_size=train_bs * 3, shuffle=False, sampler=runtime.eval_sampler(dset, args),
+                          drop_last=False, collate_fn=te_collate, **runtime.loader_options(args, persistent=False))
+
+    dset_loaders.register("target", target)
+    dset_loaders.register("test", test)
+    return dset_loaders
+
 
+def backbone_features(loader, list_path, netF_list, checkpoints, args):
+    """
+    Outputs of every (frozen) source backbone over a non-augmented loader,
+    source num x sample num x feature dim. Cached on disk, keyed by the list file,
+    the source checkpoint files the backbones were loaded from and the network name.
+    Under torchrun each rank computes the rows of its shard of loader and rank 0 writes the cache.
+    """
+    domains = [src[0].upper() for src in args.src]
+    key = hashlib.sha1((args.net + args.amp + ','.join(domains)).encode())
+    paths = [list_path] + sorted(set(checkpoints.path(domain, 'F') for domain in domains))
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                key.update(chunk)
+    cache_path = osp.join(args.output_dir, 'backbone_feats_' + key.hexdigest()[:16] + '.npy')
+    if osp.exists(cache_path):
+        if runtime.is_main(args):
+            print('Loading backbone features from ' + cache_path)
+        return torch.from_numpy(np.load(cache_path))
+
+    from tqdm import tqdm
+    if runtime.is_main(args):
+        print('Caching backbone features to ' + cache_path)
+    feats = torch.zeros(len(netF_list), len(loader.dataset), netF_list[0].in_features)
+    local_idx = []
+    # iterating loader draws its worker seeds from the global cpu RNG: fork it, so that runs that build
+    # the cache and runs that load it train with the same shuffles and augmentations for a --seed
+    with torch.random.fork_rng(devices=[]), torch.no_grad():
+        for inputs, _, idx in tqdm(loader, disable=not runtime.is_main(args)):
+            inputs = runtime.channels_last(normalize_batch(inputs.to(args.device, non_blocking=True)), args.channels_last)
+            for i in range(len(netF_list)):
+                x = inputs.to(args.source_devices[i])
+                with runtime.autocast(x.device.type, args.amp):
+                    out = netF_list[i](x)
+                feats[i, idx] = out.float().cpu()
+            local_idx.append(idx)
+    if args.distributed:
+        local_idx = torch.cat(local_idx)
+        idx, rows = runtime.all_gather_rows(local_idx, feats[:, local_idx].transpose(0, 1).contiguous())
+        feats[:, idx] = rows.transpose(0, 1)
+    if runtime.is_main(args):
+        np.save(cache_path[:-4] + '.tmp.npy', feats.numpy())
+        os.replace(cache_path[:-4] + '.tmp.npy', cache_path)
+    return feats
+
+
+def feature_load(dset_loaders, netF_list, checkpoints, args):
+    # --freeze_backbone: both loaders yield cached backbone features (batch x source num x feature dim)
+    # of the non-augmented target list in place of images. t_dset_path and test_dset_path are the
+    # same list in this script, so one cache serves training and evaluation.
+    dset = dset_loaders['test'].dataset
+    feats = backbone_features(dset_loaders['test'], args.test_dset_path, netF_list, checkpoints, args)
+    feats = feats.transpose(0, 1).contiguous()
+    labels = torch.from_numpy(dset.imgs.labels)
+    dsets = TensorDataset(feats, labels, torch.arange(len(dset)))
+    sampler = runtime.train_sampler(dsets, args)
+    dset_loaders["target"] = DataLoader(dsets, batch_size=args.batch_size, shuffle=sampler is None, sampler=sampler,
+                                        drop_last=False)
+    dset_loaders["test"] = DataLoader(dsets, batch_size=args.batch_size * 3, shuffle=False,
+                                      sampler=runtime.eval_sampler(dsets, args), drop_last=False)
     return dset_loaders
 
 
+def forward_sources(ensemble, inputs, args):
+    # With --freeze_backbone the inputs are cached backbone features (batch x source num x dim)
+    if args.freeze_backbone:
+        features_F = inputs.transpose(0, 1)
+        return (features_F,) + ensemble.forward_head(features_F)
+    return ensemble(inputs)
+
+
 def train_target(args):
     dset_loaders = data_load(args)
+    # --placement: the F/B/C stack of source i lives on its own device, netQ and the losses stay on args.device
+    if args.placement:
+        args.source_devices = args.placement.split(',')
+        assert len(args.source_devices) == len(args.src), '--placement needs one device per source'
+    else:
+        args.source_devices = [args.device] * len(args.src)
+    devices = args.source_devices
     ## set base network
+    # F/B/C are overwritten by the source checkpoints below: no ImageNet weights, no initialization
     if args.net[0:3] == 'res':
-        netF_list = [network.ResBase(res_name=args.net).cuda() for i in range(len(args.src))]
+        netF_list = [network.uninitialized(lambda: network.ResBase(res_name=args.net, pretrained=False), devices[i])
+                     for i in range(len(args.src))]
     elif args.net[0:3] == 'vgg':
-        netF_list = [network.VGGBase(vgg_name=args.net).cuda() for i in range(len(args.src))]
-
-    netB_list = [network.feat_bottleneck(type=args.classifier, feature_dim=netF_list[i].in_features,
-                                         bottleneck_dim=args.bottleneck).cuda() for i in range(len(args.src))]
-    netC_list = [
-        network.feat_classifier(type=args.layer, class_num=args.class_num, bottleneck_dim=args.bottleneck).cuda() for i
-        in range(len(args.src))]
-
-    netQ = network.source_quantizer(source_num=len(args.src)).cuda()
-
+        netF_list = [network.uninitialized(lambda: network.VGGBase(vgg_name=args.net, pretrained=False), devices[i])
+                     for i in range(len(args.src))]
+
+    netB_list = [network.uninitialized(lambda: network.feat_bottleneck(
+        type=args.classifier, feature_dim=netF_list[0].in_features, bottleneck_dim=args.bottleneck), devices[i])
+        for i in range(len(args.src))]
+    netC_list = [network.uninitialized(lambda: network.feat_classifier(
+        type=args.layer, class_num=args.class_num, bottleneck_dim=args.bottleneck), devices[i])
+        for i in range(len(args.src))]
+
+    netQ = network.source_quantizer(source_num=len(args.src)).to(args.device)
+    if args.channels_last:
+        netF_list = [netF.to(memory_format=torch.channels_last) for netF in netF_list]
+    ensemble = network.MultiSourceNet(netF_list, netB_list, netC_list, devices=devices if args.placement else None)
+
+    # sources.pt of the dataset (see checkpoint.py) when present, else the per-domain files; memory-mapped
+    checkpoints = SourceCheckpoints(osp.join(args.output_src, args.dset))
     param_group = []
     for i in range(len(args.src)):
-        modelpath = args.output_dir_src[i] + '/source_F.pt'
-        print(modelpath)
-        netF_list[i].load_state_dict(torch.load(modelpath))
+        domain = args.src[i][0].upper()
+        if runtime.is_main(args):
+            print(args.output_dir_src[i])
+        netF_list[i].load_state_dict(checkpoints.load(domain, 'F'))
         netF_list[i].eval()
         for k, v in netF_list[i].named_parameters():
-            param_group += [{'params': v, 'lr': args.lr * args.lr_decay1}]
+            if args.freeze_backbone:
+                v.requires_grad = False
+            else:
+                param_group += [{'params': v, 'lr': args.lr * args.lr_decay1}]
 
-        modelpath = args.output_dir_src[i] + '/source_B.pt'
-        print(modelpath)
-        netB_list[i].load_state_dict(torch.load(modelpath))
+        netB_list[i].load_state_dict(checkpoints.load(domain, 'B'))
         netB_list[i].eval()
         for k, v in netB_list[i].named_parameters():
             param_group += [{'params': v, 'lr': args.lr * args.lr_decay2}]
 
-        modelpath = args.output_dir_src[i] + '/source_C.pt'
-        print(modelpath)
-        netC_list[i].load_state_dict(torch.load(modelpath))
+        netC_list[i].load_state_dict(checkpoints.load(domain, 'C'))
         netC_list[i].eval()
         for k, v in netC_list[i].named_parameters():
             v.requires_grad = False
@@ -122,94 +225,109 @@ def train_target(args):
     for k, v in netQ.named_parameters():
         param_group += [{'params': v, 'lr': args.lr}]
 
+    if args.distributed:
+        # netQ is randomly initialized; the ensemble is not wrapped in DistributedDataParallel (its forward
+        # is functional), so ranks start from rank 0's weights and average gradients by hand
+        runtime.broadcast_modules(netF_list + netB_list + netC_list + [netQ])
+
+    if args.freeze_backbone:
+        dset_loaders = feature_load(dset_loaders, netF_list, checkpoints, args)
+
     optimizer = optim.SGD(param_group)
     optimizer = op_copy(optimizer)
+    scaler = runtime.grad_scaler(torch.device(args.device).type, args.amp)
 
     max_iter = args.max_epoch * len(dset_loaders["target"])
     interval_iter = max_iter // args.interval
     iter_num = 0
 
     acc_init = 0
-
+    writer = AsyncCheckpointWriter()
+    # (iter_num, inference_pass) over the test loader; weights only change in optimizer.step(), so the
+    # evaluation after step k and the pseudo-labeling before step k + 1 share one pass
+    test_pass = None
+    # --pl_mode bank: pseudo-labels are refreshed from a memory bank every bank_iter iterations
+    bank = None
+    bank_iter = max(1, interval_iter // args.bank_interval)
+    num_img, train_time = 0, 0.0
+
+    iter_test = runtime.epochs(dset_loaders["target"])
     while iter_num < max_iter:
-        try:
-            inputs_test, _, tar_idx = next(iter_test)
-        except:
-            iter_test = iter(dset_loaders["target"])
-            inputs_test, _, tar_idx = next(iter_test)
+        inputs_test, _, tar_idx = next(iter_test)
 
         if inputs_test.size(0) == 1:
             continue
 
-        if iter_num % interval_iter == 0 and args.cls_par > 0:
+        if args.cls_par > 0 and bank is not None and iter_num % bank_iter == 0:
+            memory_label, change_rate = bank.pseudo_label(memory_label, args)
+            if args.distributed:
+                # the labels and the refresh decision of rank 0, so that every rank enters the full pass or none
+                rate = torch.tensor([change_rate], device=memory_label.device)
+                dist.broadcast(memory_label, 0)
+                dist.broadcast(rate, 0)
+                change_rate = rate.item()
+            if runtime.is_main(args):
+                print('Iter:{}; pseudo-label change rate = {:.2f}%'.format(iter_num, change_rate * 100))
+            if change_rate > args.bank_refresh:
+                bank = None # the bank drifted too far, rebuild it from a full pass below
+
+        full_refresh = iter_num % interval_iter == 0 if args.pl_mode == 'full' else bank is None
+        if full_refresh and args.cls_par > 0:
 
             for i in range(len(args.src)):
                 netF_list[i].eval()
                 netB_list[i].eval()
             netQ.eval()
 
-            memory_label, _, _, _ = obtain_pseudo_label(dset_loaders['test'], netF_list, netB_list, netC_list, netQ,
-                                                        args)
-            memory_label = torch.from_numpy(memory_label).cuda() # memory_label是伪标签
+            if test_pass is None or test_pass[0] != iter_num:
+                test_pass = (iter_num, inference_pass(dset_loaders['test'], ensemble, netQ, args))
+            memory_label, _, _, _ = obtain_pseudo_label(dset_loaders['test'], ensemble, netQ, args,
+                                                        outputs=test_pass[1]) # memory_label是伪标签
+            if args.distributed:
+                dist.broadcast(memory_label, 0)
+            if args.pl_mode == 'bank':
+                bank = MemoryBank(test_pass[1], args.bank_momentum)
+                test_pass = None # the bank updates these buffers in place
 
             for i in range(len(args.src)):
                 netF_list[i].train()
                 netB_list[i].train()
             netQ.train()
 
-        inputs_test = inputs_test.cuda() # 将数据转移到GPU上
-        source_repre = torch.eye(len(args.src)).cuda() # source_repre是一个对角矩阵，nxn，n是源域的数量
+        tick = time.perf_counter()
+        inputs_test = normalize_batch(inputs_test.to(args.device, non_blocking=True)) # 将数据转移到设备上
+        inputs_test = runtime.channels_last(inputs_test, args.channels_last)
 
         iter_num += 1
         lr_scheduler(optimizer, iter_num=iter_num, max_iter=max_iter)
 
-        outputs_all = torch.zeros(len(args.src), inputs_test.shape[0], args.class_num) # outputs_all是一个三维张量，第一维是源域的数量，第二维是batch_size，第三维是类别数
-        outputs_all_re = torch.zeros(len(args.src), inputs_test.shape[0], args.class_num) # outputs_all_re是一个三维张量，第一维是源域的数量，第二维是batch_size，第三维是类别数
-        outputs_all_w = torch.zeros(inputs_test.shape[0], args.class_num) # outputs_all_w是一个二维张量，第一维是batch_size，第二维是类别数
-        init_ent = torch.zeros(1, len(args.src)) # init_ent是一个二维张量，第一维是1，第二维是源域的数量, 初始化为0， 作为熵的损失
-
-        for i in range(len(args.src)):
-            features_test = netB_list[i](netF_list[i](inputs_test))
-            outputs_test = netC_list[i](features_test)
-            softmax_prob = nn.Softmax(dim=1)(outputs_test) # 计算softmax概率， batch_size * class_num
-
-            ent_loss = torch.mean(loss.Entropy(softmax_prob)) # 计算熵的损失
-            init_ent[:, i] = ent_loss
-            outputs_all[i] = outputs_test
-
-        source_weight = netQ(source_repre).unsqueeze(0).squeeze(2) # netQ用来计算权重
-        weights_all = torch.repeat_interleave(source_weight, inputs_test.shape[0], dim=0).cpu() # 将权重重复batch_size次
+        with runtime.autocast(inputs_test.device.type, args.amp):
+            features_all_F, features_all, outputs_all = forward_sources(ensemble, inputs_test, args) # source_num * batch_size * dim
+        # 损失、netQ权重和伪标签都在fp32下计算
+        features_all_F, features_all, outputs_all = features_all_F.float(), features_all.float(), outputs_all.float()
 
-        z = torch.sum(weights_all, dim=1) # 计算权重的和
-        z = z + 1e-16 # 防止除0
-        weights_all = torch.transpose(torch.transpose(weights_all, 0, 1) / z, 0, 1) # 归一化
+        aggregator = network.SourceAggregator(netQ, len(args.src), renorm=2) # netQ用来计算权重, 归一化两次
+        outputs_all_w, = aggregator(outputs_all) # 加权后的输出, batch_size * class_num
+        outputs_all_re = aggregator.reweight(outputs_all) # 每个源域加权后的输出, source_num * batch_size * class_num
 
-        z = torch.sum(weights_all, dim=1) # 再次计算权重的和
-        z = z + 1e-16 # 防止除0
+        if bank is not None:
+            with torch.no_grad():
+                batch = [tar_idx.to(args.device), outputs_all_w] + list(aggregator(features_all, features_all_F))
+                if args.distributed:
+                    batch = runtime.all_gather_rows(*batch) # every rank keeps the whole bank up to date
+                bank.update(*batch)
 
-        weights_all = torch.transpose(torch.transpose(weights_all, 0, 1) / z, 0, 1) # 再次归一化
-        outputs_all = torch.transpose(outputs_all, 0, 1) # 转置为dim->batch_size * source_num * class_num
-
-        for i in range(inputs_test.shape[0]):
-            outputs_all_w[i] = torch.matmul(torch.transpose(outputs_all[i], 0, 1), weights_all[i]) # 计算加权后的输出, dim->batch_size * class_num
-
-        weights_all = torch.transpose(weights_all, 0, 1) # 转置为dim->source_num * batch_size
-        outputs_all = torch.transpose(outputs_all, 0, 1) # 转置为dim->source_num * batch_size * class_num
-        for i in range(len(args.src)):
-            weights_repeat = torch.repeat_interleave(weights_all[i].unsqueeze(1), args.class_num, dim=1)
-            outputs_all_re[i] = outputs_all[i] * weights_repeat # 计算加权后的输出, dim->source_num * batch_size * class_num
-
-        pred = memory_label[tar_idx].cpu().long() # tar_idx是目标域的索引， memory_label是伪标签
+        pred = memory_label[tar_idx.to(args.device)] # tar_idx是目标域的索引， memory_label是伪标签
         if args.cls_par > 0:
             classifier_loss = args.cls_par * nn.CrossEntropyLoss()(outputs_all_w, pred)
         else:
-            classifier_loss = torch.tensor(0.0)
+            classifier_loss = torch.tensor(0.0, device=outputs_all_w.device)
 
         if args.crc_par > 0:
             consistency_loss = args.crc_par * loss.KLConsistencyLoss(outputs_all_re, pred, args)
 
         else:
-            consistency_loss = torch.tensor(0.0)
+            consistency_loss = torch.tensor(0.0, device=outputs_all_w.device)
 
         classifier_loss += consistency_loss
 
@@ -224,311 +342,253 @@ def train_target(args):
             classifier_loss += im_loss
 
         optimizer.zero_grad()
-        classifier_loss.backward()
-        optimizer.step()
+        scaler.scale(classifier_loss).backward()
+        if args.distributed:
+            runtime.all_reduce_grads(optimizer)
+        scaler.step(optimizer)
+        scaler.update()
+        num_img += inputs_test.size(0) * args.world_size
+        train_time += time.perf_counter() - tick
+        if iter_num == 1 and runtime.is_main(args):
+            print('Time to first iteration: {:.1f} s'.format(time.perf_counter() - START_TIME))
 
         if iter_num % interval_iter == 0 or iter_num == max_iter:
             for i in range(len(args.src)):
                 netF_list[i].eval()
                 netB_list[i].eval()
             netQ.eval()
-            acc, _ = cal_acc_multi(dset_loaders['test'], netF_list, netB_list, netC_list, netQ, args)
-            log_str = 'Iter:{}/{}; Accuracy = {:.2f}%'.format(iter_num, max_iter, acc)
-            print(log_str + '\n')
-
-            if acc >= acc_init:
+            if test_pass is None or test_pass[0] != iter_num:
+                test_pass = (iter_num, inference_pass(dset_loaders['test'], ensemble, netQ, args))
+            acc, _ = cal_acc_multi(dset_loaders['test'], ensemble, netQ, args, outputs=test_pass[1])
+            log_str = 'Iter:{}/{}; Accuracy = {:.2f}%; Throughput = {:.1f} img/s ({})'.format(
+                iter_num, max_iter, acc, num_img / train_time, args.amp)
+            num_img, train_time = 0, 0.0
+            if runtime.is_main(args):
+                print(log_str + '\n')
+
+            if acc >= acc_init and runtime.is_main(args):
                 acc_init = acc
 
+                # 后台线程写入, 未变化的模块(如冻结的netC)不会重复写
+                checkpoints = {osp.join(args.output_dir, "target_Q" + "_" + args.savename + ".pt"): netQ}
                 for i in range(len(args.src)):
-                    torch.save(netF_list[i].state_dict(),
-                               osp.join(args.output_dir, "target_F_" + str(i) + "_" + args.savename + ".pt"))
-                    torch.save(netB_list[i].state_dict(),
-                               osp.join(args.output_dir, "target_B_" + str(i) + "_" + args.savename + ".pt"))
-                    torch.save(netC_list[i].state_dict(),
-                               osp.join(args.output_dir, "target_C_" + str(i) + "_" + args.savename + ".pt"))
-                torch.save(netQ.state_dict(),
-                           osp.join(args.output_dir, "target_Q" + "_" + args.savename + ".pt"))
-
-
-def obtain_pseudo_label(loader, netF_list, netB_list, netC_list, netQ, args):
-    start_test = True  # loader是测试数据集，这里是指定的webcam
+                    checkpoints[osp.join(args.output_dir, "target_F_" + str(i) + "_" + args.savename + ".pt")] = netF_list[i]
+                    checkpoints[osp.join(args.output_dir, "target_B_" + str(i) + "_" + args.savename + ".pt")] = netB_list[i]
+                    checkpoints[osp.join(args.output_dir, "target_C_" + str(i) + "_" + args.savename + ".pt")] = netC_list[i]
+                writer.save(checkpoints)
+
+    writer.close()
+
+
+def inference_pass(loader, ensemble, netQ, args):
+    """
+    One pass of the ensemble over loader (yielding sample indices), written into buffers on the
+    device that are preallocated from len(loader.dataset). Under torchrun every rank runs its shard
+    of loader and the rows of the other shards are all-gathered, so all ranks return full buffers.
+    Returns:
+        all_output: num_sample x K weighted logits
+        all_feature: num_sample x bottleneck_dim weighted bottleneck features
+        all_feature_F: num_sample x feature_dim weighted backbone features
+        all_label: num_sample labels
+    """
+    num_sam = len(loader.dataset)
+    buffers = None
+    local_idx = []
+    if args.distributed:
+        runtime.broadcast_modules([ensemble], buffers_only=True) # BatchNorm statistics of rank 0
     with torch.no_grad():
-        iter_test = iter(loader)
-        for _ in range(len(loader)):
-            data = next(iter_test)
-            inputs = data[0]
-            labels = data[1]
-            inputs = inputs.cuda()
-            source_repre = torch.eye(len(args.src)).cuda()  # source_repre是一个对角矩阵, nxn，n是源域的数量
-
-            # 不带w的是列表，包含了源域的数量个张量，每个张量的维度是batch_size x class_num
-            # 带w的是一个张量，维度是batch_size x class_num，聚合了源域的信息得到的结果
-            outputs_all = torch.zeros(len(args.src), inputs.shape[0],
-                                      args.class_num)  # outputs_all是一个三维张量，第一维是源域的数量，第二维是batch_size，第三维是类别数
-            outputs_all_w = torch.zeros(inputs.shape[0],
-                                        args.class_num)  # b,31 outputs_all_w是一个二维张量，第一维是batch_size，第二维是类别数
-
-            features_all = torch.zeros(len(args.src), inputs.shape[0],
-                                       args.bottleneck)  # 2,b,256 features_all是一个三维张量，第一维是源域的数量，第二维是batch_size，第三维是bottleneck的维度
-            features_all_w = torch.zeros(inputs.shape[0],
-                                         args.bottleneck)  # b,256 features_all_w是一个二维张量，第一维是batch_size，第二维是bottleneck的维度
-
-            features_all_F = torch.zeros(len(args.src), inputs.shape[0], netF_list[
-                0].in_features)  # 2,b,2048 features_all_F是一个三维张量，第一维是源域的数量，第二维是batch_size，第三维是特征提取器的输出维度
-            features_all_F_w = torch.zeros(inputs.shape[0], netF_list[
-                0].in_features)  # b,2048 features_all_F_w是一个二维张量，第一维是batch_size，第二维是特征提取器的输出维度
+        aggregator = network.SourceAggregator(netQ, len(args.src)) # netQ用来计算权重
+        for inputs, labels, idx in loader:
+            inputs = runtime.channels_last(normalize_batch(inputs.to(args.device, non_blocking=True)), args.channels_last)
+            # features_all_F: 2,b,2048; features_all: 2,b,256; outputs_all: 2,b,31
+            with runtime.autocast(inputs.device.type, args.amp):
+                features_all_F, features_all, outputs_all = forward_sources(ensemble, inputs, args)
+            outputs = aggregator(outputs_all.float(), features_all.float(), features_all_F.float()) # 聚合了源域的信息得到的结果
+
+            if buffers is None:
+                buffers = [torch.empty(num_sam, x.size(1), device=x.device) for x in outputs]
+                buffers.append(torch.empty(num_sam, device=inputs.device))
+            idx = idx.to(args.device)
+            for buf, x in zip(buffers, outputs):
+                buf[idx] = x.float()
+            buffers[3][idx] = labels.float().to(args.device)
+            local_idx.append(idx)
+    if args.distributed:
+        local_idx = torch.cat(local_idx)
+        idx, *rows = runtime.all_gather_rows(local_idx, *[buf[local_idx] for buf in buffers])
+        for buf, x in zip(buffers, rows):
+            buf[idx] = x
+    return buffers
+
+
+class MemoryBank(object):
+    """
+    Target-side memory of the weighted logits, bottleneck features and backbone features, indexed by
+    tar_idx. Initialized from a full inference_pass (whose buffers it takes over) and updated with
+    momentum from the batches of the training steps, so pseudo-labels can be re-clustered without
+    another pass over the target set.
+    """
+    def __init__(self, outputs, momentum=0.9):
+        self.all_output, self.all_feature, self.all_feature_F, self.all_label = outputs
+        self.momentum = momentum
+
+    def update(self, idx, *batch):
+        for buf, x in zip([self.all_output, self.all_feature, self.all_feature_F], batch):
+            buf[idx] = self.momentum * buf[idx] + (1 - self.momentum) * x.float()
+
+    def pseudo_label(self, memory_label, args):
+        # new pseudo-labels and the fraction of samples whose label changed
+        pred_label, _, _, _ = cluster_pseudo_label(self.all_output, self.all_feature, self.all_feature_F,
+                                                   self.all_label, args)
+        change_rate = torch.mean((pred_label != memory_label).float()).item()
+        return pred_label, change_rate
+
+
+def obtain_pseudo_label(loader, ensemble, netQ, args, outputs=None):
+    # outputs: a precomputed inference_pass over loader with the current weights
+    if outputs is None:
+        outputs = inference_pass(loader, ensemble, netQ, args)
+    all_output, all_feature, all_feature_F, all_label = outputs
+    return cluster_pseudo_label(all_output, all_feature, all_feature_F, all_label, args)
+
+
+def centroid_distance(fea, initc, distance):
+    if distance == 'cosine':
+        return 1 - torch.mm(F.normalize(fea, dim=1), F.normalize(initc, dim=1).t())
+    sq = torch.sum(fea ** 2, dim=1, keepdim=True) + torch.sum(initc ** 2, dim=1) - 2 * torch.mm(fea, initc.t())
+    return torch.sqrt(torch.clamp(sq, min=0))
+
+
+def nearest_centroids(fea, initc, distance, chunk_size):
+    # two smallest centroid distances (num_sample x 2) and the nearest centroid, chunk_size rows at a time
+    dd_min, pred_label = [], []
+    for start in range(0, fea.shape[0], chunk_size):
+        dd = centroid_distance(fea[start:start + chunk_size], initc, distance)
+        dd_min.append(dd.topk(2, dim=1, largest=False)[0])
+        pred_label.append(dd.argmin(dim=1))
+    return torch.cat(dd_min), torch.cat(pred_label)
+
+
+def cluster_pseudo_label(all_output, all_feature, all_feature_F, all_label, args):
+    """
+    Pseudo-labels from the aggregated target predictions, on the device of the inputs.
+    Args:
+        all_output: num_sample x K weighted logits
+        all_feature: num_sample x bottleneck_dim weighted bottleneck features
+        all_feature_F: num_sample x feature_dim weighted backbone features
+        all_label: num_sample ground truth, only used for logging
+    Returns:
+        pred_label, all_feature_F, label_confi (1 for confident samples), all_label
+    """
+    num_sam = all_output.size(0)
+    device = all_output.device
 
-            for i in range(len(args.src)):
-                features_F = netF_list[i](inputs)
-                features = netB_list[i](features_F)
-                outputs = netC_list[i](features)
-                outputs_all[i] = outputs
-                features_all[i] = features
-                features_all_F[i] = features_F
-
-            source_weight = netQ(source_repre).unsqueeze(0).squeeze(2) # netQ用来计算权重
-            weights_all = torch.repeat_interleave(source_weight, inputs.shape[0], dim=0).cpu()
-
-            z = torch.sum(weights_all, dim=1)
-            z = z + 1e-16
-            weights_all = torch.transpose(torch.transpose(weights_all, 0, 1) / z, 0, 1)
-
-            outputs_all = torch.transpose(outputs_all, 0, 1)
-            features_all = torch.transpose(features_all, 0, 1)
-            features_all_F = torch.transpose(features_all_F, 0, 1)
-
-            for i in range(inputs.shape[0]):
-                outputs_all_w[i] = torch.matmul(torch.transpose(outputs_all[i], 0, 1), weights_all[i])
-                features_all_w[i] = torch.matmul(torch.transpose(features_all[i], 0, 1), weights_all[i])
-                features_all_F_w[i] = torch.matmul(torch.transpose(features_all_F[i], 0, 1), weights_all[i])
-
-            if start_test:
-                all_output = outputs_all_w.float().cpu() # b*31
-                all_feature = features_all_w.float().cpu() # b*256
-                all_feature_F = features_all_F_w.float().cpu() # b*2048
-                all_label = labels.float() # b*1
-                start_test = False
-            else:
-                all_output = torch.cat((all_output, outputs_all_w.float().cpu()), 0)
-                all_feature = torch.cat((all_feature, features_all_w.float().cpu()), 0)
-                all_feature_F = torch.cat((all_feature_F, features_all_F_w.float().cpu()), 0)
-                all_label = torch.cat((all_label, labels.float()), 0)
     # STEP1: 通过计算输出类的概率获取不置信的样本
-    all_output = nn.Softmax(dim=1)(all_output)
+    all_output = nn.Softmax(dim=1)(all_output.float())
     _, predict = torch.max(all_output, 1)
-    accuracy = torch.sum(torch.squeeze(predict).float() == all_label).item() / float(all_label.size()[0])
+    accuracy = torch.sum(predict.float() == all_label).item() / float(num_sam)
 
     # Probability
-    all_prob = all_output.float().cpu().numpy()
-    prob_max_id = all_prob.argsort(axis=1)[:, -1] # 按照列排序，取最大值的索引
-    prob_max2_id = all_prob.argsort(axis=1)[:, -2] # 按照列排序，取第二大值的索引
-
-    prob_max = np.zeros(all_prob.shape[0])
-    prob_max2 = np.zeros(all_prob.shape[0])
-    for i in range(all_prob.shape[0]):
-        prob_max[i] = all_prob[i, prob_max_id[i]]
-        prob_max2[i] = all_prob[i, prob_max2_id[i]]
-    prob_diff = prob_max - prob_max2 # 计算最大值和第二大值prob的差值
-
-    prob_diff_tsr = torch.from_numpy(prob_diff).detach() # 将numpy数组转换为tensor
-    idx_unconfi_prob = prob_diff_tsr.topk(int((all_prob.shape[0] * 0.5)), largest=False)[-1] # 取最小的50%的值
-    idx_unconfi_list_prob = idx_unconfi_prob.cpu().numpy().tolist()
+    prob_top2 = all_output.topk(2, dim=1)[0]
+    prob_diff = prob_top2[:, 0] - prob_top2[:, 1] # 计算最大值和第二大值prob的差值
+    idx_unconfi_prob = prob_diff.topk(int(num_sam * 0.5), largest=False)[1] # 取最小的50%的值
+
     # STEP2: 通过计算输出类的特征和类的代表特征的余弦相似度获取不置信的样本
-    all_fea = torch.cat((all_feature, torch.ones(all_feature.size(0), 1)), 1) # 将特征和全1的列拼接，目的是为了计算余弦相似度
-    all_fea = (all_fea.t() / torch.norm(all_fea, p=2, dim=1)).t() # 归一化。 num_sample*(feature_dim+1)
-    all_fea = all_fea.float().cpu().numpy()
+    all_fea = torch.cat((all_feature.float(), torch.ones(num_sam, 1, device=device)), 1) # 将特征和全1的列拼接
+    all_fea = all_fea / torch.norm(all_fea, p=2, dim=1, keepdim=True) # 归一化。 num_sample*(feature_dim+1)
 
     K = all_output.size(1) # K是类别数
-    aff = all_output.float().cpu().numpy() # 输出的每类的概率， num_sample*K
-    initc = aff.transpose().dot(all_fea) # -> K*(feature_dim+1), 计算的结果是每类的特征的加权和，每个类的代表特征
-    initc = initc / (1e-8 + aff.sum(axis=0)[:, None]) # 归一化
-
-    dd = cdist(all_fea, initc, 'cosine') # 计算余弦相似度， 和每一类的代表特征的余弦相似度。得到的结果是num_sample*K
-    pred_label = dd.argmin(axis=1) # 取最小值的索引，得到的是预测的类别, 距离需要越小越好
-    acc = np.sum(pred_label == all_label.float().numpy()) / len(all_fea)
+    initc = torch.mm(all_output.t(), all_fea) # -> K*(feature_dim+1), 每类的特征的加权和，每个类的代表特征
+    initc = initc / (1e-8 + all_output.sum(dim=0)[:, None]) # 归一化
 
     # Distance measure
-    dd_min_id = dd.argsort(axis=1)[:, 0] # 按照列排序，取最小值的索引， num_sample * 1
-    dd_min2_id = dd.argsort(axis=1)[:, 1] # 按照列排序，取第二小值的索引, num_sample * 1
-
-    dd_min = np.zeros(dd.shape[0]) # 最小值列表, num_sample * 1
-    dd_min2 = np.zeros(dd.shape[0]) # 第二小值列表, num_sample * 1
-    for i in range(dd.shape[0]):
-        dd_min[i] = dd[i, dd_min_id[i]]
-        dd_min2[i] = dd[i, dd_min2_id[i]]
-    dd_diff = dd_min2 - dd_min # 计算最小值和第二小值的差值， num_sample * 1
-
-    dd_diff_tsr = torch.from_numpy(dd_diff).detach() # 将numpy数组转换为tensor
-    dd_t_confi = dd_diff_tsr.topk(int((dd.shape[0] * 0.5)), largest=True)[-1] # 取最大的50%的值， 最大值和次大值的差值越大，说明置信度越高
-    dd_confi_list = dd_t_confi.cpu().numpy().tolist()
-    dd_confi_list.sort()
-    idx_confi = dd_confi_list
-
-    idx_all_arr = np.zeros(shape=dd.shape[0], dtype=np.int64)
-    idx_all_arr[idx_confi] = 1 # 置信度高的样本标记为1， 置信度低的样本标记为0
-    idx_unconfi_arr = np.where(idx_all_arr == 0)
-    idx_unconfi_list_dd = list(idx_unconfi_arr[0])
-
-    idx_unconfi_list = list(set(idx_unconfi_list_dd).intersection(set(idx_unconfi_list_prob))) # 取通过两种方法都认为是不置信的样本
-    label_confi = np.ones(all_prob.shape[0], dtype="int64") # 初始化标签，所有样本都是置信的
-    label_confi[idx_unconfi_list] = 0 # 不置信的样本标记为0， 此处置信根据两个方法的结果来判断，第一个是通过输出类的概率，第二个是通过输出类的特征和类的代表特征的余弦相似度
-    _, all_idx_nn, _ = nearest_confi_anchor(all_feature_F, all_feature_F, label_confi) # 通过余弦相似度计算最近的样本 all_idx_nn是最近的样本的索引
-
-    ln = label_confi.shape[0] # 标签的数量
-    gamma = 0.15 * np.random.randn(ln, 1) + 0.85 # 生成一个随机数，用于融合
-
-    all_fea_nearest = all_fea[all_idx_nn] # 最近的样本的特征
-
-    all_fea_fuse = gamma * all_fea + (1 - gamma) * all_fea_nearest # 融合特征，自己的特征和最近的样本的特征融合
+    dd_min, pred_label = nearest_centroids(all_fea, initc, 'cosine', args.pl_chunk)
+    dd_diff = dd_min[:, 1] - dd_min[:, 0] # 计算最小值和第二小值的差值， num_sample * 1
+    idx_confi_dd = dd_diff.topk(int(num_sam * 0.5), largest=True)[1] # 取最大的50%的值，差值越大，说明置信度越高
+
+    unconfi_dd = torch.ones(num_sam, dtype=torch.bool, device=device)
+    unconfi_dd[idx_confi_dd] = False
+    unconfi_prob = torch.zeros(num_sam, dtype=torch.bool, device=device)
+    unconfi_prob[idx_unconfi_prob] = True
+    # 通过两种方法都认为是不置信的样本标记为0，其余为1
+    label_confi = (~(unconfi_dd & unconfi_prob)).long()
+    index = anchor_index.build_index(all_feature_F, args.anchor_index, args.ivf_nlist, args.ivf_nprobe)
+    _, all_idx_nn, _ = nearest_confi_anchor(all_feature_F, all_feature_F, label_confi, index=index) # all_idx_nn是最近的置信样本的索引
+
+    gamma = torch.from_numpy(0.15 * np.random.randn(num_sam, 1) + 0.85).float().to(device) # 生成一个随机数，用于融合
+    all_fea_fuse = gamma * all_fea + (1 - gamma) * all_fea[all_idx_nn] # 融合特征，自己的特征和最近的样本的特征融合
 
     for round in range(1):
-        aff = np.eye(K)[pred_label] # 生成一个对角矩阵，对角线上的值是预测的类别
-        initc = aff.transpose().dot(all_fea_fuse) # 计算每类的特征的加权和
-        initc = initc / (1e-8 + aff.sum(axis=0)[:, None]) # 归一化
-        dd_fuse = cdist(all_fea_fuse, initc, args.distance) # 计算余弦相似度
-
-        pred_label = dd_fuse.argmin(axis=1)
-        acc = np.sum(pred_label == all_label.float().numpy()) / len(all_fea)
+        initc = torch.zeros(K, all_fea_fuse.size(1), device=device).index_add_(0, pred_label, all_fea_fuse)
+        initc = initc / (1e-8 + torch.bincount(pred_label, minlength=K).float()[:, None]) # 每类的特征的均值
+        _, pred_label = nearest_centroids(all_fea_fuse, initc, args.distance, args.pl_chunk)
+        acc = torch.sum(pred_label.float() == all_label).item() / float(num_sam)
 
     log_str = 'Accuracy = {:.2f}% -> {:.2f}%'.format(accuracy * 100, acc * 100)
-    print(log_str + '\n')
-
-    return pred_label.astype('int'), all_feature_F, label_confi, all_label
-
-
-def nearest_confi_anchor(data_q, data_all, lab_confi):
-    data_q_ = data_q.detach() # 将tensor转换为numpy数组
-    data_all_ = data_all.detach() # 将tensor转换为numpy数组
-    data_q_ = data_q_.cpu().numpy() # 将tensor转换为numpy数组
-    data_all_ = data_all_.cpu().numpy() # 将tensor转换为numpy数组
-    num_sam = data_q.shape[0] # 样本数量
+    if runtime.is_main(args):
+        print(log_str + '\n')
+
+    return pred_label, all_feature_F, label_confi, all_label
+
+
+def nearest_confi_anchor(data_q, data_all, lab_confi, block_size=1024, index=None):
+    """
+    Confident anchor search: every query hops to its nearest (cosine) sample, then to that sample's
+    nearest sample and so on, never revisiting a sample of its own walk, until it reaches a confident
+    sample (lab_confi == 1). Walks that find none within LN_MEM - 1 hops fall back to the first hop.
+    Queries are processed in row blocks and only unfinished walks are searched again, so the memory
+    is block_size x num_samples instead of num_samples x num_samples.
+    Args:
+        data_q: num_sample x dim query features
+        data_all: num_sample x dim features to search
+        lab_confi: num_sample confidence flags of data_all
+        index: search index over data_all (anchor_index), exact search by default
+    Returns:
+        data_re: anchor features, idx_nn_re: anchor indices, idx_nn_step: hop of the anchor
+    """
     LN_MEM = 70 # 最大的历史记录数
-
-    flag_is_done = 0 # 是否完成的标志
-    ctr_oper = 0 # 计数器， counter of operation
-    idx_left = np.arange(0, num_sam, 1) # 未处理的样本索引
-    mtx_mem_rlt = -3 * np.ones((num_sam, LN_MEM), dtype='int64') # 记录最近的样本索引
-    mtx_mem_ignore = np.zeros((num_sam, LN_MEM), dtype='int64') # 记录忽略的样本索引
-    is_mem = 0 # 是否有历史记录
-    mtx_log = np.zeros((num_sam, LN_MEM), dtype='int64') # 记录标签
-    indices_row = np.arange(0, num_sam, 1) # 样本索引
-    nearest_idx_last = np.array([-7]) # 最近的样本索引
-
-    while flag_is_done == 0:
-
-        nearest_idx_tmp, idx_last_tmp = nearest_id_search(data_q_, data_all_, is_mem, ctr_oper, mtx_mem_ignore,
-                                                          nearest_idx_last) # 查找最近的样本索引
-        is_mem = 1
-        nearest_idx_last = nearest_idx_tmp
-
-        if ctr_oper == (LN_MEM - 1):
-            flag_sw_bad = 1
-        else:
-            flag_sw_bad = 0
-
-        mtx_mem_rlt[:, ctr_oper] = nearest_idx_tmp
-        mtx_mem_ignore[:, ctr_oper] = idx_last_tmp
-
-        lab_confi_tmp = lab_confi[nearest_idx_tmp]
-        idx_done_tmp = np.where(lab_confi_tmp == 1)[0]
-        idx_left[idx_done_tmp] = -1
-
-        if flag_sw_bad == 1:
-            idx_bad = np.where(idx_left >= 0)[0]
-            mtx_log[idx_bad, 0] = 1
-        else:
-            mtx_log[:, ctr_oper] = lab_confi_tmp
-
-        flag_len = len(np.where(idx_left >= 0)[0])
-
-        if flag_len == 0 or flag_sw_bad == 1:
-            idx_nn_step = []
-            for k in range(num_sam):
-                try:
-                    idx_ts = list(mtx_log[k, :]).index(1)
-                    idx_nn_step.append(idx_ts)
-                except:
-                    print("ts:", k, mtx_log[k, :])
-                    idx_nn_step.append(0)
-
-            idx_nn_re = mtx_mem_rlt[indices_row, idx_nn_step]
-            data_re = data_all[idx_nn_re, :]
-            flag_is_done = 1
-        else:
-            data_q_ = data_all_[nearest_idx_tmp, :]
-        ctr_oper += 1
-
+    device = data_all.device
+    if index is None:
+        index = anchor_index.ExactIndex(data_all)
+    data_q_ = F.normalize(data_q.detach().float(), dim=1)
+    data_all_ = F.normalize(data_all.detach().float(), dim=1)
+    lab_confi_ = torch.as_tensor(lab_confi).to(device).bool()
+    num_sam = data_q_.shape[0]
+
+    idx_nn_re = torch.zeros(num_sam, dtype=torch.long, device=device)
+    idx_nn_step = torch.zeros(num_sam, dtype=torch.long, device=device)
+    for start in range(0, num_sam, block_size):
+        rows = torch.arange(start, min(start + block_size, num_sam), device=device)
+        query = data_q_[rows]
+        active = torch.arange(len(rows), device=device) # 未完成的样本
+        history = torch.zeros(len(rows), LN_MEM, dtype=torch.long, device=device) # 每一步访问过的样本
+        history[:, 0] = index.search(query, history[:, :0]) # 查询样本自身
+
+        for step in range(LN_MEM - 1):
+            nearest = index.search(query, history[active, :step + 1]) # 忽略历史记录
+            history[active, step + 1] = nearest
+            if step == 0:
+                idx_nn_re[rows] = nearest
+
+            hit = lab_confi_[nearest]
+            idx_nn_re[rows[active[hit]]] = nearest[hit]
+            idx_nn_step[rows[active[hit]]] = step
+            active = active[~hit]
+            if len(active) == 0:
+                break
+            query = data_all_[nearest[~hit]]
+
+    data_re = data_all[idx_nn_re, :]
     return data_re, idx_nn_re, idx_nn_step
 
 
-def nearest_id_search(Q, X, is_mem_f, step_num, mtx_ignore,
-                      nearest_idx_last_f):
-    Xt = np.transpose(X)
-    Simo = np.dot(Q, Xt) # 得到的结果是Q和X的内积， 可以代表两个向量的相似度
-    nq = np.expand_dims(LA.norm(Q, axis=1), axis=1) # 计算Q的范数
-    nx = np.expand_dims(LA.norm(X, axis=1), axis=0) # 计算X的范数
-    Nor = np.dot(nq, nx) # 计算Q和X的范数的乘积
-    Sim = 1 - (Simo / Nor) # 计算余弦相似度，dim: Q.shape[0] * X.shape[0]
-
-    indices_min = np.argmin(Sim, axis=1) # 取最小值的索引
-    indices_row = np.arange(0, Q.shape[0], 1) #
-
-    idx_change = np.where((indices_min - nearest_idx_last_f) != 0)[0]
-    if is_mem_f == 1:
-        if idx_change.shape[0] != 0:
-            indices_min[idx_change] = nearest_idx_last_f[idx_change]
-    Sim[indices_row, indices_min] = 1000 #
-
-    # Ignore the history search records.
-    if is_mem_f == 1:
-        for k in range(step_num):
-            indices_ingore = mtx_ignore[:, k]
-            Sim[indices_row, indices_ingore] = 1000
-
-    indices_min_cur = np.argmin(Sim, axis=1)
-    indices_self = indices_min
-    return indices_min_cur, indices_self
-
-
-def cal_acc_multi(loader, netF_list, netB_list, netC_list, netQ, args):
-    start_test = True
-    with torch.no_grad():
-        iter_test = iter(loader)
-        for _ in range(len(loader)):
-            data = next(iter_test)
-            inputs = data[0]
-            labels = data[1]
-            inputs = inputs.cuda()
-            source_repre = torch.eye(len(args.src)).cuda()
-
-            outputs_all = torch.zeros(len(args.src), inputs.shape[0], args.class_num)
-            outputs_all_w = torch.zeros(inputs.shape[0], args.class_num)
-
-            for i in range(len(args.src)):
-                features = netB_list[i](netF_list[i](inputs))
-                outputs = netC_list[i](features)
-                outputs_all[i] = outputs
-
-            source_weight = netQ(source_repre).unsqueeze(0).squeeze(2)
-            weights_all = torch.repeat_interleave(source_weight, inputs.shape[0], dim=0).cpu()
-
-            z = torch.sum(weights_all, dim=1)
-            z = z + 1e-16
-            weights_all = torch.transpose(torch.transpose(weights_all, 0, 1) / z, 0, 1)
-            outputs_all = torch.transpose(outputs_all, 0, 1)
-
-            for i in range(inputs.shape[0]):
-                outputs_all_w[i] = torch.matmul(torch.transpose(outputs_all[i], 0, 1), weights_all[i])
-
-            if start_test:
-                all_output = outputs_all_w.float().cpu()
-                all_label = labels.float()
-                start_test = False
-            else:
-                all_output = torch.cat((all_output, outputs_all_w.float().cpu()), 0)
-                all_label = torch.cat((all_label, labels.float()), 0)
+def cal_acc_multi(loader, ensemble, netQ, args, outputs=None):
+    # outputs: a precomputed inference_pass over loader with the current weights
+    if outputs is None:
+        outputs = inference_pass(loader, ensemble, netQ, args)
+    all_output, _, _, all_label = outputs
     _, predict = torch.max(all_output, 1)
-    accuracy = torch.sum(torch.squeeze(predict).float() == all_label).item() / float(all_label.size()[0])
+    accuracy = torch.sum(predict.float() == all_label).item() / float(all_label.size()[0])
     mean_ent = torch.mean(loss.Entropy(nn.Softmax(dim=1)(all_output))).cpu().data.item()
     return accuracy * 100, mean_ent
 
@@ -568,8 +628,31 @@ if __name__ == "__main__":
     parser.add_argument('--layer', type=str, default="wn", choices=["linear", "wn"])
     parser.add_argument('--classifier', type=str, default="bn", choices=["ori", "bn"])
     parser.add_argument('--distance', type=str, default='cosine', choices=["euclidean", "cosine"])
+    parser.add_argument('--pl_chunk', type=int, default=8192, help="rows per chunk of the pseudo-label distance computations")
+    parser.add_argument('--anchor_index', type=str, default='exact', choices=['exact', 'ivf'],
+                        help="nearest-neighbour index of the confident anchor search")
+    parser.add_argument('--ivf_nlist', type=int, default=0, help="k-means cells of the ivf index, 0 for sqrt(num_sample)")
+    parser.add_argument('--ivf_nprobe', type=int, default=8, help="cells scanned per query, higher is more exact")
+    parser.add_argument('--pl_mode', type=str, default='full', choices=['full', 'bank'],
+                        help="refresh pseudo-labels by a full pass every interval, or from a momentum memory bank")
+    parser.add_argument('--bank_momentum', type=float, default=0.9)
+    parser.add_argument('--bank_interval', type=int, default=5, help="bank refreshes per pseudo-label interval")
+    parser.add_argument('--bank_refresh', type=float, default=0.1,
+                        help="pseudo-label change rate above which the bank is rebuilt by a full pass")
     parser.add_argument('--output', type=str, default='ckps/MSFDA')
     parser.add_argument('--output_src', type=str, default='ckps/source')
+    parser.add_argument('--cache', action='store_true', help="read images from a pre-decoded memory-mapped cache")
+    parser.add_argument('--cache_dir', type=str, default=None, help="where to keep image caches (default: next to the lists)")
+    parser.add_argument('--batch_aug', action='store_true', help="load uint8 images, crop/flip per batch and normalize on the device")
+    parser.add_argument('--freeze_backbone', action='store_true',
+                        help="keep the source backbones fixed and adapt netB/netQ on cached backbone features")
+    parser.add_argument('--device', type=str, default=None, help="cuda, cuda:<n> or cpu (default: cuda when available)")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op threads of the main process, 0 for the cores left over by the workers")
+    parser.add_argument('--placement', type=str, default=None,
+                        help="comma-separated device per source (e.g. cuda:0,cuda:1 or cpu,cpu), run concurrently")
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'], help="mixed precision for the network forward passes")
+    parser.add_argument('--channels_last', action='store_true', help="run the backbones in NHWC memory layout")
     args = parser.parse_args()
 
     if args.dset == 'office-home':
@@ -592,6 +675,7 @@ if __name__ == "__main__":
             args.src.append(names[i])
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    runtime.setup_device(args)
     SEED = args.seed
     torch.manual_seed(SEED)
     torch.cuda.manual_seed(SEED)
@@ -607,18 +691,19 @@ if __name__ == "__main__":
         args.t_dset_path = osp.join(folder, args.dset, names[args.t] + '_list.txt')
         # args.test_dset_path = folder + args.dset + '/' + names[args.t] + '_list.txt'
         args.test_dset_path = osp.join(folder, args.dset, names[args.t] + '_list.txt')
-        print(args.t_dset_path)
+        if runtime.is_main(args):
+            print(args.t_dset_path)
 
     args.output_dir_src = []
     for i in range(len(args.src)):
         args.output_dir_src.append(osp.join(args.output_src, args.dset, args.src[i][0].upper()))
-    print(args.output_dir_src)
+    if runtime.is_main(args):
+        print(args.output_dir_src)
     args.output_dir = osp.join(args.output, args.dset, names[args.t][0].upper())
 
     # if not osp.exists(args.output_dir):
     #     os.system('mkdir -p ' + args.output_dir)
-    if not osp.exists(args.output_dir):
-        os.mkdir(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True) # every rank gets here under torchrun
 
     args.savename = 'par_' + str(args.cls_par) + '_' + str(args.crc_par)
 